@@ -0,0 +1,57 @@
+import asyncio, logging
+from config import AVATAR_TTL, AVATAR_REFRESH_BATCH
+from scraping import profileImage
+import queries
+
+my_logger = logging.getLogger("mybot")
+
+# Profile images are kept on the profiles table with the time they were scraped
+# /add reuses the stored image of a profile another server already tracks instead of scraping the profile page again,
+# and images older than AVATAR_TTL are refreshed a batch at a time in the background by the task loop
+
+# The running background refresh, so two never overlap
+refresh_task = None
+
+
+# Image for /add, scraped only when the profile isn't tracked anywhere yet, ahead of the task loop's requests
+# A stale stored image is still returned straight away and refreshed in the background
+async def get_avatar(profile_name):
+    stored = await queries.get_profile_image(profile_name, AVATAR_TTL)
+    if stored and stored[0]:
+        profile_image, is_stale = stored
+        if is_stale:
+            refresh_in_background()
+        return profile_image
+
+    return await asyncio.to_thread(profileImage, profile_name, True) or None
+
+
+async def refresh_stale_avatars(limit=AVATAR_REFRESH_BATCH):
+    profile_names = await queries.get_stale_profile_images(AVATAR_TTL, limit)
+    if not profile_names:
+        return 0
+
+    # Scraped one after another, these are low priority next to the diary feeds sharing the same rate limiter
+    rows = []
+    for profile_name in profile_names:
+        profile_image = await asyncio.to_thread(profileImage, profile_name)
+        rows.append((profile_name, profile_image or None))
+    await queries.update_profile_images(rows)
+
+    refreshed = sum(1 for _, profile_image in rows if profile_image)
+    my_logger.info(f"Refreshed {refreshed} of {len(rows)} stale profile images")
+    return refreshed
+
+
+# Starts a refresh unless one is already running, never waits on it
+def refresh_in_background():
+    global refresh_task
+    if refresh_task is None or refresh_task.done():
+        refresh_task = asyncio.create_task(run_refresh())
+
+
+async def run_refresh():
+    try:
+        await refresh_stale_avatars()
+    except Exception as e:
+        my_logger.error(f"Error refreshing profile images: {e}")
@@ -0,0 +1,218 @@
+import argparse, json, os, platform, sys, tempfile, threading, time, tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Offline benchmarks for the scraping.py parsers and build_embed_message()
+# Every request goes to a local HTTP stand-in for letterboxd.com serving the files in benchmarks/fixtures,
+# so the numbers only move when the parsing (or the request plumbing around it) does
+# Run from the repo root:
+#   python benchmarks/bench_parsers.py              compare against benchmarks/baseline.json
+#   python benchmarks/bench_parsers.py --save       store this run as the new baseline
+# Exits with 1 when a case got slower or allocates more than the tolerance allows
+# Baselines are only comparable on the same machine, re-save after moving to a new one
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+# Profile name -> fixture served for /<profile>/rss/
+FEEDS = {
+    "small": "rss_small.xml",
+    "typical": "rss_typical.xml",
+    "full": "rss_full.xml",
+    "lists": "rss_lists.xml",   # typical feed with list posts mixed in, which have no film title
+}
+# Profile name -> fixture served for /<profile>/, every other profile gets the page with favourites
+PROFILE_PAGES = {
+    "nofavs": "profile_no_favourites.html",
+}
+DEFAULT_PROFILE_PAGE = "profile_favourites.html"
+WATCHLIST_PAGE = "watchlist.html"
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), "rb") as f:
+        return f.read()
+
+
+# Serves the fixtures from memory the way letterboxd.com lays out its urls
+# Only the first watchlist page exists, so watchlistScrape() stops after one page like it does for a short watchlist
+class FixtureHandler(BaseHTTPRequestHandler):
+    fixtures = {}
+
+    def do_GET(self):
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        name = None
+        content_type = "text/html; charset=utf-8"
+        if len(parts) == 2 and parts[1] == "rss" and parts[0] in FEEDS:
+            name = FEEDS[parts[0]]
+            content_type = "application/rss+xml; charset=utf-8"
+        elif len(parts) == 1:
+            name = PROFILE_PAGES.get(parts[0], DEFAULT_PROFILE_PAGE)
+        elif len(parts) == 2 and parts[1] == "watchlist":
+            name = WATCHLIST_PAGE
+
+        if name is None:
+            self.send_error(404)
+            return
+        body = self.fixtures[name]
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_standin():
+    FixtureHandler.fixtures = {name: load_fixture(name) for name in os.listdir(FIXTURES_DIR)}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Times 'func' for at least 'min_time' seconds after a short warm-up
+# Returns ops/sec and the peak memory allocated by one call, in KiB
+def measure(func, min_time):
+    for _ in range(3):
+        func()
+
+    calls = 0
+    started = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return calls / elapsed, peak / 1024
+
+
+# Each case is (name, function to time, check run once up front so a broken fixture or parser
+# isn't benchmarked on its error path)
+def build_cases():
+    from scraping import diaryScrape_rss, diaryParse_rss, firstScrape_rss, favoriteFilmsScrape, profileImage, watchlistScrape
+    from helper import build_embed_message
+
+    no_watermark = (None, None, None)
+    profile_url = "https://letterboxd.com/benchuser/"
+    profile_image = "https://a.ltrbxd.com/avatar.jpg"
+
+    cases = []
+    for size in FEEDS:
+        cases.append((
+            f"diaryScrape_rss[{size}]",
+            lambda size=size: diaryScrape_rss(size, no_watermark),
+            lambda result: result[0] is True and None not in result[1],
+        ))
+    cases += [
+        ("firstScrape_rss[typical]", lambda: firstScrape_rss("typical"), lambda result: result[0] is True and result[8]),
+        ("firstScrape_rss[lists]", lambda: firstScrape_rss("lists"), lambda result: result[0] is True and result[1] == "Perfect Days"),
+        ("favoriteFilmsScrape[favourites]", lambda: favoriteFilmsScrape("favs"), lambda result: len(result) == 4),
+        ("favoriteFilmsScrape[no_favourites]", lambda: favoriteFilmsScrape("nofavs"), lambda result: result == "No favorites"),
+        ("profileImage", lambda: profileImage("favs"), lambda result: result and result.startswith("https://")),
+        ("watchlistScrape", lambda: watchlistScrape("watch"), lambda result: len(result) == 28),
+    ]
+    for size, fixture in FEEDS.items():
+        # Every item of the feed, so the full case builds 50 embeds
+        parsed = diaryParse_rss(load_fixture(fixture), size, no_watermark, limit=50)
+        cases.append((
+            f"build_embed_message[{size}]",
+            lambda parsed=parsed: build_embed_message(parsed, profile_url, "benchuser", profile_image),
+            lambda result: result and len(result[0]) >= 1,
+        ))
+    return cases
+
+
+def load_baseline():
+    if not os.path.exists(BASELINE_PATH):
+        return None
+    with open(BASELINE_PATH) as f:
+        return json.load(f)
+
+
+def save_baseline(results):
+    baseline = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cases": {name: {"ops_per_sec": round(ops, 2), "peak_kib": round(peak, 1)} for name, ops, peak in results},
+    }
+    with open(BASELINE_PATH, "w") as f:
+        json.dump(baseline, f, indent=2)
+        f.write("\n")
+
+
+# Prints one line per case and returns the names of the cases that regressed
+# Peak memory gets a little absolute slack on top of the tolerance, small cases move by a few KiB between runs
+def report(results, baseline, tolerance):
+    regressions = []
+    print(f"{'case':<38} {'ops/sec':>10} {'peak KiB':>10} {'vs baseline':>24}")
+    for name, ops, peak in results:
+        line = f"{name:<38} {ops:>10.1f} {peak:>10.1f}"
+        base = (baseline or {}).get("cases", {}).get(name)
+        if base:
+            speed = ops / base["ops_per_sec"]
+            memory = peak / base["peak_kib"] if base["peak_kib"] else 1.0
+            slower = speed < 1 - tolerance
+            bigger = peak > base["peak_kib"] * (1 + tolerance) + 16
+            flag = "  REGRESSION" if slower or bigger else ""
+            line += f" {speed:>10.2f}x speed {memory:>5.2f}x mem{flag}"
+            if flag:
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Letterboxd parsers against local fixtures")
+    parser.add_argument("--save", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds to time each case for")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown/extra memory before a case counts as regressed")
+    parser.add_argument("cases", nargs="*", help="only run cases whose name contains one of these")
+    args = parser.parse_args()
+
+    server = start_standin()
+    host, port = server.server_address
+    # Both have to be set before config is imported
+    os.environ["LETTERBOXD_URL"] = f"http://{host}:{port}"
+    os.environ.setdefault("BOT_SECRETS", "env")
+
+    # The stand-in shouldn't be throttled like the real site
+    import ratelimit
+    ratelimit.limiters[host] = ratelimit.TokenBucket(host, 1e9, 1e9, 1e9)
+
+    # watchlistScrape() writes the page it fetched to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="bench_parsers_"))
+
+    results = []
+    for name, func, check in build_cases():
+        if args.cases and not any(selected in name for selected in args.cases):
+            continue
+        if not check(func()):
+            sys.exit(f"{name} returned an unexpected result, check the fixtures before benchmarking")
+        ops, peak = measure(func, args.min_time)
+        results.append((name, ops, peak))
+
+    server.shutdown()
+
+    if args.save:
+        save_baseline(results)
+        report(results, None, args.tolerance)
+        print(f"Saved baseline to {BASELINE_PATH}")
+        return
+
+    regressions = report(results, load_baseline(), args.tolerance)
+    if regressions:
+        sys.exit(f"{len(regressions)} case(s) regressed: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+import argparse, asyncio, json, multiprocessing, os, random, socket, sys, time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+# Load simulator for the diary task loop
+# Runs diary.run_diary_loop() once against:
+#   - a fake letterboxd.com, run in its own process, serving generated feeds with a set share of new entries and latency
+#   - fake Discord text channels that record what gets sent to them
+#   - a local Postgres database seeded with the generated guilds, channels and profiles
+# and reports the loop's wall time, the requests it made, the rows it wrote and the messages it sent
+# Run from the repo root against the database from local_files/.env (BOT_SECRETS=env is set for you):
+#   python benchmarks/simulate_load.py --profiles 10000 --guilds 1000 --slots 1
+# The simulation gets its own database (--database), which is wiped and re-seeded on every run
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+FEED_SIZE = 50  # Letterboxd feeds carry the 50 most recent diary entries
+FEED_START = datetime(2025, 10, 28, 20, 0, tzinfo=timezone.utc)  # pubDate of every generated feed's newest entry
+WORDS = "a quiet film about grief and light in a city at night tender funny and long".split()
+
+# The tables the bot was created with, schema.py's migrations build on top of these
+BASE_TABLES = """
+    CREATE TABLE discord_servers (
+        server_id BIGINT PRIMARY KEY,
+        user_count INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMPTZ
+    );
+    CREATE TABLE server_channels (
+        channel_id BIGINT NOT NULL,
+        server_id BIGINT NOT NULL REFERENCES discord_servers (server_id) ON DELETE CASCADE,
+        updated_at TIMESTAMPTZ,
+        PRIMARY KEY (channel_id, server_id)
+    );
+    CREATE TABLE diary_users (
+        profile_name VARCHAR(15) NOT NULL,
+        server_id BIGINT NOT NULL REFERENCES discord_servers (server_id) ON DELETE CASCADE,
+        last_entry TEXT,
+        profile_url TEXT,
+        profile_image TEXT,
+        updated_at TIMESTAMPTZ,
+        PRIMARY KEY (profile_name, server_id)
+    )"""
+
+
+### Generated Letterboxd data ###
+# Everything is derived from the profile name and --seed, so the fake server and the database seeding agree
+# on which entries are new without talking to each other
+
+def profile_names(count):
+    return [f"sim{i:05d}" for i in range(count)]
+
+
+# Number of entries a profile logged since its stored watermark
+def new_entry_count(profile_name, seed, new_rate):
+    rng = random.Random(f"{seed}:{profile_name}:new")
+    if rng.random() >= new_rate:
+        return 0
+    return rng.choice((1, 1, 1, 2, 3))
+
+
+# The profile's feed items, newest first, as dicts of the fields render_feed() writes
+def feed_items(profile_name, seed):
+    rng = random.Random(f"{seed}:{profile_name}:items")
+    pub_date = FEED_START - timedelta(minutes=rng.randrange(0, 600))
+    items = []
+    for i in range(FEED_SIZE):
+        number = FEED_SIZE - i
+        items.append({
+            "guid": f"letterboxd-review-{profile_name}-{number}",
+            "pub_date": pub_date,
+            "title": f"Film {profile_name[-3:]}{number:02d}",
+            "year": str(rng.randrange(1950, 2026)),
+            "rating": rng.choice(("", "2.5", "3.0", "3.5", "4.0", "4.5", "5.0")),
+            "rewatch": "Yes" if rng.random() < 0.1 else "No",
+            "review": " ".join(rng.choices(WORDS, k=rng.randrange(20, 120))) if rng.random() < 0.4 else None,
+        })
+        pub_date -= timedelta(hours=rng.randrange(6, 96))
+    return items
+
+
+# The entry the database is seeded with as already posted, so exactly new_entry_count() items come before it
+def seeded_watermark(profile_name, seed, new_rate):
+    item = feed_items(profile_name, seed)[new_entry_count(profile_name, seed, new_rate)]
+    return item["title"], item["guid"], item["pub_date"]
+
+
+def render_item(profile_name, item):
+    slug = item["title"].lower().replace(" ", "-")
+    stars = f" - {'★' * int(float(item['rating']))}" if item["rating"] else ""
+    if item["review"]:
+        body = f"<p>{item['review']}</p>"
+    else:
+        body = f"<p>Watched on {item['pub_date']:%A %B %d, %Y}.</p>"
+    rating = f"<letterboxd:memberRating>{item['rating']}</letterboxd:memberRating>" if item["rating"] else ""
+    return f"""<item>
+<title>{item['title']}, {item['year']}{stars}</title>
+<link>https://letterboxd.com/{profile_name}/film/{slug}/</link>
+<guid isPermaLink="false">{item['guid']}</guid>
+<pubDate>{format_datetime(item['pub_date'])}</pubDate>
+<letterboxd:watchedDate>{item['pub_date']:%Y-%m-%d}</letterboxd:watchedDate>
+<letterboxd:rewatch>{item['rewatch']}</letterboxd:rewatch>
+<letterboxd:filmTitle>{item['title']}</letterboxd:filmTitle>
+<letterboxd:filmYear>{item['year']}</letterboxd:filmYear>
+{rating}
+<description><![CDATA[ <p><img src="https://a.ltrbxd.com/resized/film-poster/{slug}-0-600-0-900-crop.jpg"/></p> {body} ]]></description>
+<dc:creator>{profile_name}</dc:creator>
+</item>"""
+
+
+def render_feed(profile_name, seed):
+    items = "".join(render_item(profile_name, item) for item in feed_items(profile_name, seed))
+    return f"""<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:letterboxd="https://letterboxd.com" xmlns:tmdb="https://themoviedb.org">
+<channel><title>Letterboxd - {profile_name}</title><link>https://letterboxd.com/{profile_name}/</link>
+<description>Letterboxd - {profile_name}</description>{items}</channel></rss>""".encode("utf-8")
+
+
+def render_profile_page(profile_name):
+    return f"""<html><body><section class="profile-header">
+<span class="avatar -a110 -large"><img src="https://a.ltrbxd.com/avatar/{profile_name}-0-220-0-220-crop.jpg" alt="{profile_name}"/></span>
+</section></body></html>""".encode("utf-8")
+
+
+### Fake letterboxd.com ###
+
+# Runs in its own process so serving the feeds doesn't share the event loop (or the GIL) with the loop being measured
+# Feeds come from the profile name and seed, any profile name is a valid profile
+# GET /__stats returns the counts of what was served
+def serve_letterboxd(sock, seed, latency, error_rate):
+    from aiohttp import web
+
+    rng = random.Random(seed)
+    feeds = {}
+    stats = {"feeds": 0, "pages": 0, "errors": 0, "not_found": 0, "bytes": 0}
+
+    async def handle(request):
+        parts = [part for part in request.path.split("/") if part]
+        if parts == ["__stats"]:
+            return web.json_response(stats)
+
+        await asyncio.sleep(latency * rng.uniform(0.5, 1.5))
+        if rng.random() < error_rate:
+            stats["errors"] += 1
+            return web.Response(status=503)
+
+        if len(parts) == 2 and parts[1] == "rss":
+            stats["feeds"] += 1
+            if parts[0] not in feeds:
+                feeds[parts[0]] = render_feed(parts[0], seed)
+            body = feeds[parts[0]]
+            content_type = "application/rss+xml"
+        elif len(parts) == 1:
+            stats["pages"] += 1
+            body = render_profile_page(parts[0])
+            content_type = "text/html"
+        else:
+            stats["not_found"] += 1
+            return web.Response(status=404)
+
+        stats["bytes"] += len(body)
+        return web.Response(body=body, content_type=content_type, charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/{path:.*}", handle)
+    web.run_app(app, sock=sock, print=None, handle_signals=False)
+
+
+def start_letterboxd(seed, latency, error_rate):
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(1024)
+    process = multiprocessing.Process(target=serve_letterboxd, args=(sock, seed, latency, error_rate), daemon=True)
+    process.start()
+    return process, sock.getsockname()
+
+
+### Fake Discord ###
+
+# Passes the dispatcher's isinstance(channel, discord.TextChannel) check without a gateway connection
+# Every send takes 'latency' seconds and is counted instead of posted
+def fake_channel_type():
+    import discord
+
+    class FakeTextChannel(discord.TextChannel):
+        def __init__(self, channel_id, latency):
+            self.id = channel_id
+            self.latency = latency
+            self.messages = 0
+            self.embeds = 0
+
+        async def send(self, content=None, *, embeds=None, **kwargs):
+            await asyncio.sleep(self.latency)
+            self.messages += 1
+            self.embeds += len(embeds or ())
+
+    return FakeTextChannel
+
+
+class FakeBot:
+    def __init__(self, channels):
+        self.channels = channels
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    async def fetch_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+
+### Database ###
+
+def create_database(name):
+    import psycopg2
+    from config import db_password, db_port
+
+    conn = psycopg2.connect(host="localhost", dbname="postgres", user="postgres", password=db_password, port=db_port)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (name,))
+            if not cur.fetchone():
+                cur.execute(f'CREATE DATABASE "{name}"')
+    finally:
+        conn.close()
+
+
+# Every guild gets one channel and tracks 'per_guild' random profiles, only the profiles someone tracks are stored
+# Returns the list of (channel_id, server_id, profile_name) subscriptions
+def seed_database(options):
+    from psycopg2.extras import execute_values
+    from database import get_db_connection, close_pool
+    from schema import apply_migrations
+    from scheduler import profile_slot
+
+    rng = random.Random(options.seed)
+    names = profile_names(options.profiles)
+    subscriptions = []
+    for guild in range(options.guilds):
+        server_id = 1_000_000 + guild
+        for profile_name in rng.sample(names, min(options.per_guild, len(names))):
+            subscriptions.append((2_000_000 + guild, server_id, profile_name))
+    tracked = sorted({profile_name for _, _, profile_name in subscriptions})
+
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public")
+        cur.execute(BASE_TABLES)
+        conn.commit()
+    apply_migrations()
+
+    with get_db_connection() as conn, conn.cursor() as cur:
+        execute_values(cur, "INSERT INTO discord_servers (server_id, user_count, updated_at) VALUES %s",
+                       [(1_000_000 + guild, min(options.per_guild, len(names)), datetime.now(timezone.utc)) for guild in range(options.guilds)])
+        execute_values(cur, "INSERT INTO server_channels (channel_id, server_id, updated_at) VALUES %s",
+                       [(2_000_000 + guild, 1_000_000 + guild, datetime.now(timezone.utc)) for guild in range(options.guilds)])
+        profile_rows = []
+        for profile_name in tracked:
+            last_entry, last_guid, last_pub_date = seeded_watermark(profile_name, options.seed, options.new_rate)
+            profile_rows.append((profile_name, f"https://letterboxd.com/{profile_name}/", f"https://a.ltrbxd.com/avatar/{profile_name}.jpg",
+                                 last_entry, last_guid, last_pub_date, profile_slot(profile_name)))
+        # Images are seeded as freshly fetched, the background avatar refresh isn't part of what's measured
+        execute_values(cur, """INSERT INTO profiles (profile_name, profile_url, profile_image, last_entry, last_guid, last_pub_date, slot, image_fetched_at)
+                       VALUES %s""", profile_rows, template="(%s, %s, %s, %s, %s, %s, %s, now())", page_size=1000)
+        execute_values(cur, "INSERT INTO profile_subscriptions (profile_name, server_id) VALUES %s",
+                       [(profile_name, server_id) for _, server_id, profile_name in subscriptions], page_size=1000)
+        conn.commit()
+    close_pool()
+    return subscriptions
+
+
+# Transaction and row counters of the simulation database, as Postgres counts them
+# Backends only report their counters when they finish, so the pool has to be closed before this is read
+def database_counters(name):
+    from database import get_db_connection, close_pool
+
+    close_pool()
+    time.sleep(0.5)
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute("""SELECT xact_commit, tup_inserted, tup_updated, tup_deleted
+                    FROM pg_stat_database WHERE datname = %s""", (name,))
+        commits, inserted, updated, deleted = cur.fetchone()
+    close_pool()
+    return {"commits": commits, "inserted": inserted, "updated": updated, "deleted": deleted}
+
+
+def fetch_letterboxd_stats(address):
+    from urllib.request import urlopen
+    with urlopen(f"http://{address[0]}:{address[1]}/__stats") as response:
+        return json.load(response)
+
+
+### Simulation ###
+
+async def run_tick(options, subscriptions, address):
+    import ratelimit
+    from config import DIARY_CATCH_UP_LIMIT
+    from delivery import Dispatcher
+    from diary import run_diary_loop
+    from scheduler import profile_slot
+
+    if options.unthrottled:
+        ratelimit.limiters[address[0]] = ratelimit.TokenBucket(address[0], 1e9, 1e9, 1e9)
+
+    FakeTextChannel = fake_channel_type()
+    channels = {channel_id: FakeTextChannel(channel_id, options.send_latency)
+                for channel_id in {channel_id for channel_id, _, _ in subscriptions}}
+    dispatcher = Dispatcher(FakeBot(channels))
+
+    slots = list(range(options.slots))
+    due = [row for row in subscriptions if profile_slot(row[2]) in slots]
+    expected_embeds = sum(min(new_entry_count(profile_name, options.seed, options.new_rate), DIARY_CATCH_UP_LIMIT)
+                          for _, _, profile_name in due)
+
+    started = time.perf_counter()
+    await run_diary_loop(slots, dispatcher)
+    loop_time = time.perf_counter() - started
+    await asyncio.gather(*dispatcher.workers.values())
+    delivered_time = time.perf_counter() - started
+
+    return {
+        "slots": len(slots),
+        "subscriptions_due": len(due),
+        "profiles_due": len({profile_name for _, _, profile_name in due}),
+        "loop_seconds": round(loop_time, 3),
+        "delivered_seconds": round(delivered_time, 3),
+        "messages_sent": sum(channel.messages for channel in channels.values()),
+        "embeds_sent": sum(channel.embeds for channel in channels.values()),
+        "embeds_expected": expected_embeds,
+        "channels_posted_to": sum(1 for channel in channels.values() if channel.messages),
+        "send_retries": dispatcher.stats["retried"],
+        "dead_lettered": dispatcher.stats["dead"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run one diary loop tick against fake Letterboxd and Discord")
+    parser.add_argument("--profiles", type=int, default=10000, help="Letterboxd profiles to generate")
+    parser.add_argument("--guilds", type=int, default=1000, help="servers to generate, one channel each")
+    parser.add_argument("--per-guild", type=int, default=20, help="profiles tracked by each server")
+    parser.add_argument("--new-rate", type=float, default=0.1, help="share of profiles with new entries")
+    parser.add_argument("--latency", type=float, default=150, help="mean Letterboxd response time in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of Letterboxd requests answered with a 503")
+    parser.add_argument("--send-latency", type=float, default=100, help="Discord message send time in ms")
+    parser.add_argument("--slots", type=int, default=1, help="time wheel slots to run in the tick, SCHEDULER_SLOTS polls every profile")
+    parser.add_argument("--unthrottled", action="store_true", help="don't apply the per-host scrape rate limit")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--database", default="discordbotdb_loadtest", help="database to create and seed, wiped on every run")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    options = parser.parse_args()
+
+    if options.database == "discordbotdb":
+        sys.exit("Refusing to seed the bot's own database, pick another --database")
+
+    letterboxd, address = start_letterboxd(options.seed, options.latency / 1000, options.error_rate)
+    # All of these have to be set before config is imported
+    os.environ["LETTERBOXD_URL"] = f"http://{address[0]}:{address[1]}"
+    os.environ["DB_NAME"] = options.database
+    os.environ.setdefault("BOT_SECRETS", "env")
+    options.send_latency /= 1000
+
+    import logging
+    logger = logging.getLogger("mybot")
+    logger.setLevel(logging.WARNING)
+    logger.addHandler(logging.StreamHandler())
+    logger.propagate = False
+
+    try:
+        create_database(options.database)
+        seed_started = time.perf_counter()
+        subscriptions = seed_database(options)
+        seed_time = time.perf_counter() - seed_started
+
+        before = database_counters(options.database)
+        report = asyncio.run(run_tick(options, subscriptions, address))
+        after = database_counters(options.database)
+        served = fetch_letterboxd_stats(address)
+    finally:
+        letterboxd.terminate()
+
+    report["letterboxd_requests"] = served
+    # The counters also see the counting queries themselves, one commit per read
+    report["database"] = {key: after[key] - before[key] for key in before}
+    report["database"]["commits"] -= 1
+
+    if options.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"Seeded {options.guilds} guilds, {len(subscriptions)} subscriptions in {seed_time:.1f}s")
+    print(f"Tick over {report['slots']} slot(s): {report['profiles_due']} profiles, {report['subscriptions_due']} subscriptions due")
+    print(f"  loop wall time       {report['loop_seconds']:.2f}s")
+    print(f"  until all delivered  {report['delivered_seconds']:.2f}s")
+    print(f"  letterboxd fetches   {served['feeds']} feeds, {served['pages']} profile pages, {served['errors']} errors, {served['bytes'] / 1e6:.1f} MB")
+    print(f"  database             {report['database']['commits']} commits, {report['database']['inserted']} inserted, "
+          f"{report['database']['updated']} updated, {report['database']['deleted']} deleted rows")
+    print(f"  discord sends        {report['messages_sent']} messages to {report['channels_posted_to']} channels, "
+          f"{report['embeds_sent']}/{report['embeds_expected']} embeds, {report['send_retries']} retries, {report['dead_lettered']} dead-lettered")
+
+
+if __name__ == "__main__":
+    main()
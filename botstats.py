@@ -0,0 +1,72 @@
+import argparse, asyncio, logging
+from datetime import datetime
+from config import TASK_LOOP_INTERVAL, SCHEDULER_SLOTS
+from scheduler import SLOT_SECONDS
+import queries
+
+# Summarizes the task loop runs stored in the loop_runs table
+# Every run has to finish within its time wheel slot (TASK_LOOP_INTERVAL / SCHEDULER_SLOTS), a run that takes longer
+# delays the next slot and the wheel starts catching up, so run times are shown against that budget
+# Run with: uv run botstats.py [--days 14]
+
+my_logger = logging.getLogger("mybot")
+my_logger.setLevel(logging.INFO)
+my_logger.addHandler(logging.StreamHandler())
+my_logger.propagate = False
+
+
+# Least squares slope of 'values' per step, None with fewer than two points
+def trend(values):
+    if len(values) < 2:
+        return None
+    n = len(values)
+    mean_x = (n - 1) / 2
+    mean_y = sum(values) / n
+    spread = sum((x - mean_x) ** 2 for x in range(n))
+    return sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values)) / spread
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Summarize the diary task loop runs")
+    parser.add_argument("--days", type=int, default=14, help="days of runs to summarize")
+    parser.add_argument("--slowest", type=int, default=10, help="slowest profiles to list")
+    args = parser.parse_args()
+
+    summary = await queries.get_loop_run_summary(args.days)
+    if not summary:
+        print(f"No task loop runs in the last {args.days} days.")
+        return
+
+    print(f"Slot budget: {SLOT_SECONDS:.0f}s per run (TASK_LOOP_INTERVAL {TASK_LOOP_INTERVAL} min / {SCHEDULER_SLOTS} slots)")
+    print()
+    print(f"{'day':<12}{'runs':>6}{'avg s':>9}{'p95 s':>9}{'max s':>9}{'p95 %':>8}{'profiles':>10}{'entries':>9}{'sent':>8}{'errors':>8}{'failed':>8}")
+    for day, runs, avg, p95, longest, profiles, entries, sent, errors, failed in summary:
+        print(f"{day:%Y-%m-%d}  {runs:>6}{avg:>9.2f}{p95:>9.2f}{longest:>9.2f}{p95 / SLOT_SECONDS:>8.0%}"
+              f"{profiles:>10.0f}{entries:>9}{sent:>8}{errors:>8}{failed:>8}")
+
+    # Oldest day first for the trend, today is left out since it's only partly over
+    full_days = summary[1:] if summary[0][0].date() == datetime.now(summary[0][0].tzinfo).date() else summary
+    daily_p95 = [row[3] for row in reversed(full_days)]
+    slope = trend(daily_p95)
+    print()
+    if slope is None:
+        print("Not enough full days for a trend yet.")
+    elif slope <= 0:
+        print(f"p95 run time is flat or falling ({slope:+.2f}s/day).")
+    else:
+        days_left = (SLOT_SECONDS - daily_p95[-1]) / slope
+        print(f"p95 run time is growing {slope:+.2f}s/day, at this rate it reaches the slot budget in {max(days_left, 0):.0f} days.")
+    over_budget = sum(1 for row in summary if row[4] > SLOT_SECONDS)
+    if over_budget:
+        print(f"Runs went over the slot budget on {over_budget} of the last {len(summary)} days.")
+
+    slowest = await queries.get_slowest_profiles(args.days, args.slowest)
+    if slowest:
+        print()
+        print(f"{'slowest profiles':<20}{'runs':>6}{'max s':>9}{'avg s':>9}")
+        for profile_name, runs, longest, avg in slowest:
+            print(f"{profile_name:<20}{runs:>6}{longest:>9.2f}{avg:>9.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,25 +1,56 @@
-import os
+import os, json, time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from google.cloud import secretmanager
 import logging
 
 my_logger = logging.getLogger("mybot")
 
 MAX_USER_COUNT_PER_SERVER = 50
+LETTERBOXD_URL = os.getenv("LETTERBOXD_URL", "https://letterboxd.com")  # pointed at a local stand-in by the benchmarks
 TASK_LOOP_INTERVAL = 30  # in minutes
+SCHEDULER_SLOTS = 30  # TASK_LOOP_INTERVAL is split into this many slots, each profile is polled in one of them
+MAX_POLL_INTERVAL = 12 * 60  # in minutes, longest a dormant profile goes between polls
+POLL_BACKOFF_FACTOR = 0.02  # poll interval as a fraction of how long a profile has been quiet, a day quiet still rounds to every turn
+ACTIVITY_SMOOTHING = 0.3  # weight of the newest gap between diary entries in a profile's average gap
+DIARY_CATCH_UP_LIMIT = 20  # most new entries posted for one profile in one poll, older ones past this are skipped
+AVATAR_TTL = 7 * 24 * 60 * 60  # in seconds, how long a stored profile image is trusted before it's scraped again
+AVATAR_REFRESH_BATCH = 20  # stale profile images refreshed in the background per task loop run
+MAX_CONCURRENT_SENDS = 20  # channels the dispatcher sends to at the same time
+SEND_MAX_ATTEMPTS = 4  # tries per message before it goes to the dead-letter log
+SEND_RETRY_DELAY = 2  # in seconds, doubled after every failed try
+SCRAPE_IN_WORKERS = False  # True to leave polling to worker.py processes through the poll_jobs table
+WORKER_BATCH_SIZE = 20  # poll jobs a worker claims at once
+WORKER_IDLE_SLEEP = 5  # in seconds, how long a worker waits before checking an empty queue again
+POLL_JOB_TIMEOUT = 5 * 60  # in seconds, running jobs older than this are handed to another worker
+POLL_JOB_MAX_ATTEMPTS = 3
+POLL_RESULTS_PER_LOOP = 1000  # finished poll jobs the task loop posts per slot
+LAST_ENTRY_FLUSH_SIZE = 500  # last_entry updates buffered by the task loop before they are committed
+MAX_CONCURRENT_REQUESTS_PER_HOST = 8  # Letterboxd requests allowed in flight at once during the task loop
+REQUEST_TIMEOUT = 10  # in seconds
+LOOP_RUN_SLOWEST = 10  # slowest profiles kept in each loop_runs row
+LOOP_RUN_RETENTION = 90 * 24 * 60 * 60  # in seconds, loop_runs rows older than this are deleted
+METRICS_PORT = 8000  # Prometheus metrics are served on /metrics here, None to turn the endpoint off
+SCRAPE_REQUESTS_PER_SECOND = 5  # Starting and maximum request rate per host, lowered automatically on 429/5xx
+SCRAPE_BURST = 10
+SCRAPE_MIN_REQUESTS_PER_SECOND = 0.5
+DB_POOL_MIN_SIZE = 1
+DB_POOL_MAX_SIZE = 10
+DB_POOL_HEALTH_CHECK_AFTER = 30  # in seconds, idle time before a pooled connection is pinged on checkout
+OMDB_CACHE_SIZE = 2000  # films kept in memory
+OMDB_CACHE_TTL = 7 * 24 * 60 * 60  # in seconds
+OMDB_NEGATIVE_CACHE_TTL = 24 * 60 * 60  # in seconds, for titles OMDb couldn't find
+OMDB_LOOKUP_TIMEOUT = 5  # in seconds, per OMDb request
 
-# Comment out the load_dotenv and os.getenv lines when deploying to Google Cloud
-# Soley used for local testing with a .env file
-# load_dotenv(dotenv_path="./local_files/.env")
-# token = os.getenv("DISCORD_TOKEN_TEST")
-# db_password = os.getenv("DB_PASSWORD")
-# api_key = os.getenv("OMDb_API_KEY")
-# db_port = 5433  # Change to 5433 for local testing if needed
+SECRETS_CACHE_PATH = "./local_files/secrets_cache.json"  # secrets from the last start, reused by restarts within SECRETS_CACHE_TTL
+SECRETS_CACHE_TTL = 24 * 60 * 60  # in seconds, delete the file to pick up a rotated secret sooner
+COMMAND_TREE_HASH_PATH = "./local_files/command_tree.{application_id}.sha256"  # fingerprint of the last synced slash commands, one per bot application
 
 # Pulls private variables from Google Cloud hosted in their Secrets Manager
-def access_secret(project_id: str, secret_id: str, version: str = "latest") -> str:
+# The client library is imported on first use, it takes a while to load and isn't needed when the cache is fresh
+def access_secret(project_id: str, secret_id: str, version: str = "latest", client=None) -> str:
     try:
-        client = secretmanager.SecretManagerServiceClient()
+        from google.cloud import secretmanager
+        client = client or secretmanager.SecretManagerServiceClient()
         name = f"projects/{project_id}/secrets/{secret_id}/versions/{version}"
 
         response = client.access_secret_version(name=name)
@@ -28,9 +59,74 @@ def access_secret(project_id: str, secret_id: str, version: str = "latest") -> s
     except Exception as e:
         my_logger.error(f"Error in 'access_secret' function: {e}")
 
-# Uncomment and set your Google Cloud project ID and secret names when deploying
-project_id = "discord-bit-468008"
-token = access_secret(project_id, "BotToken")   
-db_password = access_secret(project_id, "BotDatabasePassword")
-api_key = access_secret(project_id, "OMDb_API_KEY")
-db_port = 5432  # Default PostgreSQL port for production
\ No newline at end of file
+
+# Fetches every secret at the same time through one client, returns secret_id -> value (None if it failed)
+def access_secrets(project_id, secret_ids):
+    try:
+        from google.cloud import secretmanager
+        client = secretmanager.SecretManagerServiceClient()
+    except Exception as e:
+        my_logger.error(f"Error creating Secret Manager client: {e}")
+        return {secret_id: None for secret_id in secret_ids}
+    with ThreadPoolExecutor(max_workers=len(secret_ids)) as executor:
+        values = executor.map(lambda secret_id: access_secret(project_id, secret_id, client=client), secret_ids)
+        return dict(zip(secret_ids, values))
+
+
+def read_secrets_cache(max_age):
+    try:
+        if time.time() - os.path.getmtime(SECRETS_CACHE_PATH) > max_age:
+            return None
+        with open(SECRETS_CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# Only readable by the bot's own user, written to a temporary file first so a crash never leaves half a file
+def write_secrets_cache(secrets):
+    try:
+        os.makedirs(os.path.dirname(SECRETS_CACHE_PATH), exist_ok=True)
+        temp_path = f"{SECRETS_CACHE_PATH}.tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(secrets, f)
+        os.replace(temp_path, SECRETS_CACHE_PATH)
+    except OSError as e:
+        my_logger.error(f"Failed to write secrets cache: {e}")
+
+
+# Secrets from the cache file while it's fresh, otherwise from Secret Manager
+# If Secret Manager can't be reached, a stale cache still beats not starting at all
+def load_secrets(project_id, secret_ids):
+    cached = read_secrets_cache(SECRETS_CACHE_TTL)
+    if cached and all(cached.get(secret_id) for secret_id in secret_ids):
+        return cached
+
+    secrets = access_secrets(project_id, secret_ids)
+    if all(secrets.values()):
+        write_secrets_cache(secrets)
+        return secrets
+
+    stale = read_secrets_cache(float("inf")) or {}
+    my_logger.warning("Couldn't fetch every secret, falling back to the cached copy where there is one")
+    return {secret_id: secrets[secret_id] or stale.get(secret_id) for secret_id in secret_ids}
+
+# Set BOT_SECRETS=env for local testing and the offline benchmarks, the secrets are then read from
+# the environment or a .env file instead of Google Cloud
+if os.getenv("BOT_SECRETS") == "env":
+    load_dotenv(dotenv_path="./local_files/.env")
+    token = os.getenv("DISCORD_TOKEN_TEST")
+    db_password = os.getenv("DB_PASSWORD")
+    api_key = os.getenv("OMDb_API_KEY")
+    db_port = int(os.getenv("DB_PORT", 5433))  # 5433 for local testing
+    db_name = os.getenv("DB_NAME", "discordbotdb")
+else:
+    # Set your Google Cloud project ID and secret names when deploying
+    project_id = "discord-bit-468008"
+    secrets = load_secrets(project_id, ["BotToken", "BotDatabasePassword", "OMDb_API_KEY"])
+    token = secrets["BotToken"]
+    db_password = secrets["BotDatabasePassword"]
+    api_key = secrets["OMDb_API_KEY"]
+    db_port = 5432  # Default PostgreSQL port for production
+    db_name = "discordbotdb"
\ No newline at end of file
@@ -0,0 +1,98 @@
+import psycopg2, logging, threading, time
+from psycopg2 import pool, extensions
+from contextlib import contextmanager
+from config import db_password, db_port, db_name, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_HEALTH_CHECK_AFTER
+
+my_logger = logging.getLogger("mybot")
+
+# Process-wide pool shared by main.py and helper.py, created on first use
+connection_pool = None
+pool_lock = threading.Lock()
+# psycopg2's pool raises instead of waiting when it's empty, so checkouts queue up on this semaphore first
+pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)
+# Connection -> last time it was handed back, used to decide when a connection needs a health check
+last_used = {}
+
+
+def get_pool():
+    global connection_pool
+    with pool_lock:
+        if connection_pool is None:
+            connection_pool = pool.ThreadedConnectionPool(
+                DB_POOL_MIN_SIZE,
+                DB_POOL_MAX_SIZE,
+                host="localhost",
+                database=db_name,
+                user="postgres",
+                password=db_password,
+                port=db_port
+            )
+        return connection_pool
+
+
+# Connections that sat idle for a while get a 'SELECT 1' before being handed out
+# so a server restart or dropped socket doesn't surface as a failed command
+def is_healthy(conn):
+    if conn.closed:
+        return False
+    if time.monotonic() - last_used.get(id(conn), 0) < DB_POOL_HEALTH_CHECK_AFTER:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def checkout():
+    connection_pool = get_pool()
+    # One retry with a fresh connection if the pooled one turned out to be dead
+    for _ in range(2):
+        conn = connection_pool.getconn()
+        if is_healthy(conn):
+            return conn
+        my_logger.warning("Discarding broken database connection from pool")
+        last_used.pop(id(conn), None)
+        connection_pool.putconn(conn, close=True)
+    return connection_pool.getconn()
+
+
+def release(conn):
+    close = bool(conn.closed)
+    if not close and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+        # Anything left uncommitted is rolled back so the next user gets a clean connection
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            close = True
+    if close:
+        last_used.pop(id(conn), None)
+    else:
+        last_used[id(conn)] = time.monotonic()
+    get_pool().putconn(conn, close=close)
+
+
+# Checks a connection out of the pool for the length of the 'with' block
+# Callers still commit themselves, whatever is left open when the block exits gets rolled back
+@contextmanager
+def get_db_connection():
+    pool_slots.acquire()
+    try:
+        conn = checkout()
+        try:
+            yield conn
+        finally:
+            release(conn)
+    finally:
+        pool_slots.release()
+
+
+def close_pool():
+    global connection_pool
+    with pool_lock:
+        if connection_pool is not None:
+            connection_pool.closeall()
+            connection_pool = None
+            last_used.clear()
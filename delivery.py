@@ -0,0 +1,125 @@
+import aiohttp, asyncio, discord, json, logging
+from collections import deque
+from config import MAX_CONCURRENT_SENDS, SEND_MAX_ATTEMPTS, SEND_RETRY_DELAY
+from metrics import STAGE_SECONDS, SENDS
+
+my_logger = logging.getLogger("mybot")
+# Messages that couldn't be delivered, one JSON line each with the embeds so they can be looked at or resent
+dead_letter_logger = logging.getLogger("deadletter")
+
+# Discord's limits for a single message
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARS_PER_MESSAGE = 6000
+
+
+# Groups embeds, in order, into as few messages as fit within Discord's embed count and total character limits
+# len() of an Embed is its character count as Discord counts it (title, description, fields, footer, author)
+def batch_embeds(embeds):
+    batches = []
+    batch = []
+    chars = 0
+    for embed in embeds:
+        size = len(embed)
+        if batch and (len(batch) >= MAX_EMBEDS_PER_MESSAGE or chars + size > MAX_EMBED_CHARS_PER_MESSAGE):
+            batches.append(batch)
+            batch = []
+            chars = 0
+        batch.append(embed)
+        chars += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+# Rate limits, Discord side errors and dropped connections are worth another try, anything else won't get better
+def is_retryable(error):
+    if isinstance(error, (discord.Forbidden, discord.NotFound)):
+        return False
+    if isinstance(error, discord.HTTPException):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+
+
+# Sends the task loop's posts without holding up the loop itself
+# Every channel gets its own queue, drained by its own task, so a slow channel or a rate limited one only
+# delays itself. Message sends are bucketed per channel by Discord (and by discord.py's HTTP client),
+# so one queue per channel lines up with one rate limit bucket and channels never wait on each other's buckets
+# Failed sends are retried in place with a doubling delay, keeping the channel's order, and end up in the
+# dead-letter log after SEND_MAX_ATTEMPTS or straight away when the error is permanent (missing channel, no permissions)
+class Dispatcher:
+    def __init__(self, bot):
+        self.bot = bot
+        self.queues = {}    # channel_id -> deque of (server_id, embeds)
+        self.workers = {}   # channel_id -> task draining that channel's queue
+        self.send_slots = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+        self.stats = {"sent": 0, "retried": 0, "dead": 0}
+
+    # Queues a channel's embeds, packed into as few messages as possible, and makes sure the channel is being drained
+    # Returns the number of messages queued
+    def submit(self, channel_id, server_id, embeds):
+        queue = self.queues.setdefault(channel_id, deque())
+        batches = batch_embeds(embeds)
+        for batch in batches:
+            queue.append((server_id, batch))
+
+        worker = self.workers.get(channel_id)
+        if worker is None or worker.done():
+            self.workers[channel_id] = asyncio.create_task(self.drain(channel_id))
+        return len(batches)
+
+    def pending(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def get_channel(self, channel_id):
+        with STAGE_SECONDS.time("fetch_channel"):
+            return self.bot.get_channel(channel_id) or await self.bot.fetch_channel(channel_id)
+
+    # Runs until the channel's queue is empty, submit() starts a new one when more messages come in
+    async def drain(self, channel_id):
+        queue = self.queues[channel_id]
+        try:
+            channel = await self.get_channel(channel_id)
+            if not isinstance(channel, discord.TextChannel):
+                raise TypeError(f"Channel {channel_id} is not a text channel.")
+        except Exception as e:
+            my_logger.warning(f"Can't deliver to channel {channel_id}: {e!r}")
+            while queue:
+                server_id, embeds = queue.popleft()
+                self.dead_letter(channel_id, server_id, embeds, e, 1)
+            return
+
+        while queue:
+            server_id, embeds = queue[0]
+            await self.send(channel, server_id, embeds)
+            queue.popleft()
+
+    async def send(self, channel, server_id, embeds):
+        for attempt in range(1, SEND_MAX_ATTEMPTS + 1):
+            try:
+                async with self.send_slots:
+                    with STAGE_SECONDS.time("send"):
+                        await channel.send(embeds=embeds)
+                self.stats["sent"] += 1
+                SENDS.inc("sent")
+                return
+            except Exception as e:
+                if not is_retryable(e) or attempt == SEND_MAX_ATTEMPTS:
+                    my_logger.error(f"Error sending Task Loop message to {channel.id} of server {server_id}: {e!r}")
+                    self.dead_letter(channel.id, server_id, embeds, e, attempt)
+                    return
+                delay = getattr(e, "retry_after", None) or SEND_RETRY_DELAY * 2 ** (attempt - 1)
+                my_logger.warning(f"Send to channel {channel.id} failed ({e!r}), retrying in {delay}s")
+                self.stats["retried"] += 1
+                SENDS.inc("retried")
+                await asyncio.sleep(delay)
+
+    def dead_letter(self, channel_id, server_id, embeds, error, attempts):
+        self.stats["dead"] += 1
+        SENDS.inc("dead")
+        dead_letter_logger.error(json.dumps({
+            "channel_id": channel_id,
+            "server_id": server_id,
+            "attempts": attempts,
+            "error": repr(error),
+            "embeds": [embed.to_dict() for embed in embeds],
+        }))
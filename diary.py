@@ -0,0 +1,144 @@
+import logging, time
+from datetime import datetime, timezone
+from config import LAST_ENTRY_FLUSH_SIZE, SCRAPE_IN_WORKERS, POLL_RESULTS_PER_LOOP, LOOP_RUN_SLOWEST, LOOP_RUN_RETENTION
+from poller import poll_profiles, cache_hit_rate, load_validators, build_messages, upgrade_watermarks
+from jobqueue import enqueue_polls, collect_poll_results
+from avatars import refresh_in_background
+from scheduler import DUE_WITHIN, plan_next_polls
+from metrics import STAGE_SECONDS, SCRAPE_OUTCOMES, SENDS
+import queries
+
+my_logger = logging.getLogger("mybot")
+
+
+# Process-wide totals, a run's report is the difference between their values before and after it
+# Messages are sent in the background, so each run is credited with the sends since the previous run ended
+def run_counters():
+    return {
+        "fetch_seconds": STAGE_SECONDS.total("fetch_feed"),
+        "parse_seconds": STAGE_SECONDS.total("parse"),
+        "scrape_errors": SCRAPE_OUTCOMES.get("error") + SCRAPE_OUTCOMES.get("404"),
+    }
+
+sent_at_last_run = 0
+
+
+# One run of the diary task loop over the profiles in 'slots' of the time wheel
+# Lives outside main.py so it can be driven without a connected bot, 'dispatcher' only needs to look like delivery.Dispatcher
+async def run_diary_loop(slots, dispatcher):
+    my_logger.info(f"Task loop has began for slot(s) {slots}.")
+    global sent_at_last_run
+    started = time.perf_counter()
+    started_at = datetime.now(timezone.utc)
+    counters = run_counters()
+
+    no_entry_users = {}
+    new_entry_users = {}
+    outbox = {}     # (channel_id, server_id) -> embeds to send
+    last_entries = queries.LastEntryBatch(LAST_ENTRY_FLUSH_SIZE)
+    job_ids = []
+    timings = {}    # profile_name -> seconds spent fetching and parsing its feed
+    profiles_polled = 0
+    new_entries = 0
+    messages_queued = 0
+    error = None
+
+    try:
+        if SCRAPE_IN_WORKERS:
+            # Posts what the workers finished since the last slot, then queues this slot's profiles for them
+            job_ids, prepared, changed_validators, cache_stats, activity = await collect_poll_results(POLL_RESULTS_PER_LOOP)
+            results = await queries.get_diary_rows_for(activity)
+            schedule = await queries.load_poll_schedule(activity)
+            due_rows = await queries.get_diary_rows(slots, DUE_WITHIN)
+            queued = await enqueue_polls(due_rows)
+            profiles_polled = len(job_ids)
+            my_logger.info(f"Queued {queued} poll jobs, posting {len(prepared)} results from workers")
+        else:
+            results = await queries.get_diary_rows(slots, DUE_WITHIN)
+
+            # Each profile is only scraped once per loop, even if multiple servers track it
+            profiles = {}
+            for _, _, profile_name, watermark, _, _ in results:
+                profiles.setdefault(profile_name, watermark)
+
+            schedule, validators = await load_validators(profiles)
+            scraped, changed_validators, cache_stats, activity = await poll_profiles(profiles, validators, timings)
+            profiles_polled = len(profiles)
+            prepared = await build_messages(scraped, results, activity)
+
+        # Each profile's watermark is written once, however many servers it gets posted to
+        for profile_name, (embeds, film_title, (guid, pub_date)) in prepared.items():
+            await last_entries.add(profile_name, film_title, guid, pub_date)
+            new_entry_users[profile_name] = film_title
+            new_entries += len(embeds)
+        for profile_name, watermark in upgrade_watermarks(results, prepared, activity).items():
+            await last_entries.add(profile_name, *watermark)
+
+        # Watermarks are committed before anything is posted. A profile whose write failed isn't posted this run
+        # and keeps its old validators and schedule, so its next poll parses the feed again and posts the entries then,
+        # instead of a saved ETag hiding them until the feed changes and they go out a second time
+        await last_entries.flush()
+        failed = last_entries.failed
+        if failed:
+            my_logger.warning(f"Watermarks of {len(failed)} profiles weren't written, leaving them for their next poll")
+            changed_validators = {name: value for name, value in changed_validators.items() if name not in failed}
+            activity = {name: seen for name, seen in activity.items() if name not in failed}
+
+        for channel_id, server_id, profile_name, watermark, profile_url, profile_image in results:
+            if profile_name not in prepared:
+                no_entry_users[profile_name] = server_id
+                continue
+            if profile_name in failed:
+                continue
+            outbox.setdefault((channel_id, server_id), []).extend(prepared[profile_name][0])
+
+        # Every channel's new entries from this run are handed to the dispatcher, which sends them
+        # in the background on the channel's own queue, so the loop doesn't wait on Discord
+        for (channel_id, server_id), embeds in outbox.items():
+            messages_queued += dispatcher.submit(channel_id, server_id, embeds)
+
+        await queries.save_feed_validators(changed_validators)
+        await queries.save_poll_schedule(plan_next_polls(schedule, activity))
+        await queries.delete_poll_jobs(job_ids)
+        my_logger.info(
+            f"Feed cache hit rate: {cache_hit_rate(cache_stats):.1%} "
+            f"({cache_stats['not_modified']} not modified, {cache_stats['unchanged']} unchanged, "
+            f"{cache_stats['modified']} parsed, {cache_stats['failed']} failed, {cache_stats['bytes']} bytes downloaded)"
+        )
+        # Stale profile images are refreshed a batch at a time, without holding up the loop
+        refresh_in_background()
+        my_logger.info(
+            f"Dispatcher: {dispatcher.pending()} messages queued, {dispatcher.stats['sent']} sent, "
+            f"{dispatcher.stats['retried']} retries, {dispatcher.stats['dead']} dead-lettered so far"
+        )
+
+    except Exception as e:
+        my_logger.error(f"Scheduled task failed: {e}")
+        error = repr(e)
+        # Buffered watermarks are left unwritten, their entries weren't posted yet
+        # Finished jobs aren't posted twice, their validators weren't saved so the next poll finds any unposted entries again
+        await queries.delete_poll_jobs(job_ids)
+
+    elapsed = time.perf_counter() - started
+    STAGE_SECONDS.observe("tick", elapsed)
+    my_logger.info(f"Task loop has finished in {elapsed:.2f}s, {len(new_entry_users)} profiles with new entries, {len(no_entry_users)} without.")
+    my_logger.debug(f"Users with no new entries this loop: {no_entry_users.keys()}")
+    my_logger.debug(f"Users with new entries this loop: {new_entry_users.keys()}")
+
+    # Kept in loop_runs for botstats.py, worker mode polls elsewhere so its fetch/parse times and slowest profiles stay empty
+    sent = SENDS.get("sent")
+    slowest = sorted(timings.items(), key=lambda item: item[1], reverse=True)[:LOOP_RUN_SLOWEST]
+    run = {
+        "started_at": started_at,
+        "finished_at": datetime.now(timezone.utc),
+        "slots": len(slots),
+        "profiles_polled": profiles_polled,
+        **{key: value - counters[key] for key, value in run_counters().items()},
+        "new_entries": new_entries,
+        "messages_queued": messages_queued,
+        "messages_sent": sent - sent_at_last_run,
+        "error": error,
+        "slowest_profiles": [{"profile_name": name, "seconds": round(seconds, 3)} for name, seconds in slowest],
+    }
+    sent_at_last_run = sent
+    await queries.save_loop_run(run, LOOP_RUN_RETENTION)
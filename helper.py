@@ -1,20 +1,12 @@
 from discord import Embed
-import psycopg2, logging
-from config import db_password, db_port
+import psycopg2, logging, hashlib, json, os
+from bisect import bisect_left
+from config import COMMAND_TREE_HASH_PATH
+from queries import get_server_channel, get_all_server_channels, get_all_subscriptions
 
 my_logger = logging.getLogger("mybot")
 
 
-def get_db_connection():
-    return psycopg2.connect(
-        host="localhost",
-        database="discordbotdb",
-        user="postgres",
-        password=db_password,
-        port=db_port
-    )
-
-
 def build_embed_message(data, profile_url, profile_name, profile_image): 
     try:
         _, film_title, film_release, film_rating, film_review, diary_url, film_rewatch, film_poster, throwaway_var = data
@@ -97,54 +89,129 @@ def build_embed_message(data, profile_url, profile_name, profile_image):
     except Exception as e:
         my_logger.error(f"Error in 'build_embed_message': {e}")
 
+# In-memory copy of server_channels (guild_id -> channel_id) so the channel check on every command
+# doesn't need a database round trip. Loaded in on_ready() and written through by the channel commands
+guild_channels = {}
+guild_channels_loaded = False
+
+async def load_channel_cache():
+    global guild_channels_loaded
+    channels = await get_all_server_channels()
+    guild_channels.clear()
+    guild_channels.update(channels)
+    guild_channels_loaded = True
+    my_logger.info(f"Loaded {len(guild_channels)} server channel(s) into cache")
+
+def cache_channel(guild_id, channel_id):
+    guild_channels[guild_id] = channel_id
+
+def uncache_channel(guild_id):
+    guild_channels.pop(guild_id, None)
+
 # Used to check if the server user performed the bot commands in the correct channel
 # Verifies with the channel stored from the `/setchannel` command
-def check_channel(channel_id, guild_id):
-    conn = None
-    cur = None
+# Falls back to the database only if a command comes in before the cache has been loaded
+async def check_channel(channel_id, guild_id):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        select_query = """SELECT channel_id
-        FROM server_channels
-        WHERE server_id = %s"""
-        cur.execute(select_query, (guild_id,))
-        channel = cur.fetchone()
-        cur.close()
-        conn.close()
-
-        if not channel:
+        if guild_channels_loaded:
+            stored_channel_id = guild_channels.get(guild_id)
+        else:
+            stored_channel_id = await get_server_channel(guild_id)
+
+        if not stored_channel_id:
             return "no_exist", None
         
-        stored_channel_id = channel[0]
         if  channel_id != stored_channel_id:
             return "no_match", stored_channel_id
         
         return "ok", stored_channel_id
     except psycopg2.Error as e:
         my_logger.error(f"Error in 'check channel' function: {e}")
-    finally:
-        if cur: cur.close()
-        if conn: conn.close()
-
-# Stores the users' most recent entry in their letterboxd diary into the database
-# This function solely used with the task loop currently to handle updates
-def update_last_entry(server_id, profile_name, film_title):
-    conn = None
-    cur = None
+
+
+# Sorted list of names, a prefix lookup is two binary searches and a slice
+class PrefixIndex:
+    def __init__(self, names=()):
+        self.names = sorted(set(names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        i = bisect_left(self.names, name)
+        return i < len(self.names) and self.names[i] == name
+
+    def add(self, name):
+        i = bisect_left(self.names, name)
+        if i == len(self.names) or self.names[i] != name:
+            self.names.insert(i, name)
+
+    def remove(self, name):
+        i = bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            del self.names[i]
+
+    def complete(self, prefix, limit):
+        start = bisect_left(self.names, prefix)
+        end = bisect_left(self.names, prefix + "\uffff", start)
+        return self.names[start:min(end, start + limit)]
+
+
+# In-memory copy of profile_subscriptions for the username autocomplete, so suggesting names never waits on the database
+# Only a guild's own profiles are ever suggested to it, which profiles other servers track isn't shared
+# Loaded in on_ready() and written through by /add, /remove and on_guild_remove()
+guild_profiles = {}     # guild_id -> PrefixIndex of the profiles it tracks
+
+MAX_CHOICES = 25    # Discord shows at most 25 autocomplete choices
+
+async def load_profile_index():
+    by_guild = {}
+    for guild_id, profile_name in await get_all_subscriptions():
+        by_guild.setdefault(guild_id, []).append(profile_name)
+    guild_profiles.clear()
+    guild_profiles.update({guild_id: PrefixIndex(names) for guild_id, names in by_guild.items()})
+    my_logger.info(f"Loaded tracked profiles of {len(guild_profiles)} server(s) into autocomplete index")
+
+def index_profile(guild_id, profile_name):
+    guild_profiles.setdefault(guild_id, PrefixIndex()).add(profile_name)
+
+def unindex_profile(guild_id, profile_name):
+    index = guild_profiles.get(guild_id)
+    if index is not None:
+        index.remove(profile_name)
+
+def unindex_guild(guild_id):
+    guild_profiles.pop(guild_id, None)
+
+# Profiles the guild tracks that start with what's been typed so far
+def complete_profiles(guild_id, current):
+    index = guild_profiles.get(guild_id)
+    return index.complete(current.strip().lower(), MAX_CHOICES) if index else []
+
+
+# Syncs the slash commands with Discord only when they changed since the last sync, instead of on every on_ready()
+# The fingerprint is a hash of the commands as they'd be sent to Discord, kept in COMMAND_TREE_HASH_PATH across restarts
+# Each application (the test and production bot run from the same tree) gets its own file, so a sync under one
+# never makes the other skip its own
+# Returns the synced commands, or None if nothing needed syncing
+async def sync_command_tree(tree):
+    application_id = tree.client.application_id
+    payload = {"application_id": application_id, "commands": [command.to_dict(tree) for command in tree.get_commands()]}
+    fingerprint = hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+    hash_path = COMMAND_TREE_HASH_PATH.format(application_id=application_id)
+
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """UPDATE diary_users
-            SET last_entry = %s, updated_at = now()
-            WHERE profile_name = %s AND server_id = %s""",
-            (film_title, profile_name, server_id)
-        )
-        conn.commit()
-    except psycopg2.Error as e:
-        my_logger.error(f"Error in diary loop update query: {e}")
-        conn.rollback()
-    finally:
-        if cur: cur.close()
-        if conn: conn.close()
\ No newline at end of file
+        with open(hash_path) as f:
+            if f.read().strip() == fingerprint:
+                return None
+    except OSError:
+        pass
+
+    synced = await tree.sync()
+    try:
+        os.makedirs(os.path.dirname(hash_path), exist_ok=True)
+        with open(hash_path, "w") as f:
+            f.write(fingerprint)
+    except OSError as e:
+        my_logger.error(f"Failed to store command tree fingerprint: {e}")
+    return synced
@@ -0,0 +1,59 @@
+import logging
+from discord import Embed
+from config import POLL_JOB_TIMEOUT, POLL_JOB_MAX_ATTEMPTS
+from poller import new_cache_stats, load_validators
+from scraping import parsePubDate
+import queries
+
+my_logger = logging.getLogger("mybot")
+
+
+# Gateway side of the poll_jobs queue, the polling itself is done by worker.py
+# A job carries everything a worker needs to poll a profile and build its embeds, and comes back
+# with ready-to-send embeds plus the watermark, validators and pubDates the task loop stores after posting
+
+# Queues one poll job per profile in the given diary rows, returns how many were queued
+async def enqueue_polls(rows):
+    profiles = {}
+    for _, _, profile_name, watermark, profile_url, profile_image in rows:
+        profiles.setdefault(profile_name, (*watermark, profile_url, profile_image))
+    if not profiles:
+        return 0
+
+    _, validators = await load_validators(profiles)
+    jobs = [(profile_name, *info, *validators.get(profile_name, (None, None, None)))
+            for profile_name, info in profiles.items()]
+    return await queries.enqueue_poll_jobs(jobs)
+
+
+# Collects the jobs workers have finished since the last call
+# Returns the job ids (deleted by the caller once the results are posted), a dict of profile_name -> (embeds, film_title, watermark)
+# for profiles with new entries, the validators that changed, cache stats and the (guid, pubDate) of the items seen per profile
+async def collect_poll_results(limit):
+    requeued = await queries.requeue_stale_poll_jobs(POLL_JOB_TIMEOUT, POLL_JOB_MAX_ATTEMPTS)
+    if requeued:
+        my_logger.warning(f"Requeued or failed {requeued} poll jobs from unresponsive workers")
+
+    job_ids = []
+    prepared = {}
+    changed_validators = {}
+    stats = new_cache_stats()
+    activity = {}
+
+    for job_id, profile_name, status, result in await queries.get_finished_poll_jobs(limit):
+        job_ids.append(job_id)
+        if status == "failed" or not result or not result["status"]:
+            stats["failed"] += 1
+            continue
+
+        stats[result["status"]] += 1
+        stats["bytes"] += result["size"]
+        activity[profile_name] = [tuple(item) for item in result["seen"]]
+        if result["validators"]:
+            changed_validators[profile_name] = tuple(result["validators"])
+        if result["embeds"]:
+            guid, pub_date = activity[profile_name][0]
+            embeds = [Embed.from_dict(embed) for embed in result["embeds"]]
+            prepared[profile_name] = (embeds, result["film_title"], (guid, parsePubDate(pub_date)))
+
+    return job_ids, prepared, changed_validators, stats, activity
@@ -1,19 +1,18 @@
-import discord, logging, psycopg2, asyncio, logging, requests, random
+import discord, logging, psycopg2, asyncio, logging
 from discord.ext import commands, tasks
 from discord import app_commands, Embed, TextChannel
-from config import token, db_password, api_key, db_port, MAX_USER_COUNT_PER_SERVER, TASK_LOOP_INTERVAL
-from scraping import firstScrape_rss, diaryScrape_rss, favoriteFilmsScrape, profileImageOnReady
-from helper import build_embed_message, update_last_entry, check_channel
-
-
-def get_db_connection():
-    return psycopg2.connect(
-        host="localhost",
-        database="discordbotdb",
-        user="postgres",
-        password=db_password,
-        port=db_port
-    )
+from config import token, MAX_USER_COUNT_PER_SERVER, METRICS_PORT
+from scraping import firstScrape_rss, favoriteFilmsScrape
+from helper import build_embed_message, check_channel, load_channel_cache, cache_channel, uncache_channel, sync_command_tree
+from helper import load_profile_index, index_profile, unindex_profile, unindex_guild, complete_profiles
+from delivery import Dispatcher
+from avatars import get_avatar
+from schema import apply_migrations
+from omdb import get_film, get_films, is_found, load_film_cache
+from scheduler import TimeWheel, SLOT_SECONDS, profile_slot
+from diary import run_diary_loop
+from metrics import start_metrics_server
+import queries
 
 # Logger setup for all custom code logging
 my_logger = logging.getLogger("mybot")
@@ -26,6 +25,13 @@ handler.setFormatter(formatter)
 my_logger.addHandler(handler)
 my_logger.propagate = False
 
+# Logger setup for diary posts the dispatcher gave up on, kept across restarts
+dead_letter_logger = logging.getLogger("deadletter")
+dead_letter_handler = logging.FileHandler("deadletter.log", mode="a", encoding="utf-8")
+dead_letter_handler.setFormatter(formatter)
+dead_letter_logger.addHandler(dead_letter_handler)
+dead_letter_logger.propagate = False
+
 # Logger setup for only discord api logging
 handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
 intents = discord.Intents.default()
@@ -33,35 +39,38 @@ intents.message_content = True
 intents.members = True
 
 bot = commands.Bot(command_prefix='!', intents=intents)
+time_wheel = TimeWheel()
+dispatcher = Dispatcher(bot)
 
 @bot.event
 async def on_ready():
     my_logger.info(f"We are ready to go in, {bot.user.name}")
-    current_guild_ids = {guild.id for guild in bot.guilds}
-    conn = None
-    cur = None
 
     try:        # Checks if servers are registered in the database, incase on_guild_join() failed to initialize 
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT server_id FROM discord_servers")
-        results = cur.fetchall()
-        stored_ids = {row[0] for row in results}
-
-        missing_ids = current_guild_ids - stored_ids
-
-        for guild in bot.guilds:
-            if guild.id in missing_ids:
-                try:
-                    insert_query = """INSERT INTO discord_servers (server_id, user_count, updated_at)
-                                    VALUES (%s, %s, now())
-                                    ON CONFLICT (server_id) DO NOTHING;"""
-                    cur.execute(insert_query, (guild.id, 0))
-                    my_logger.info(f"Added missed guild {guild.name} ({guild.id}) to database.")
-                except psycopg2.Error as e:
-                    my_logger.error(f"Failed to insert guild {guild.name} ({guild.id}): {e}")
-                else:
-                    conn.commit()
+        await asyncio.to_thread(apply_migrations)
+
+        try:
+            added_ids, removed_ids = await queries.reconcile_guilds([guild.id for guild in bot.guilds])
+            for guild_id in added_ids:
+                guild = bot.get_guild(guild_id)
+                my_logger.info(f"Added missed guild {guild.name} ({guild_id}) to database.")
+            for guild_id in removed_ids:
+                my_logger.info(f"Removed guild {guild_id} the bot left while offline from database.")
+        except psycopg2.Error as e:
+            my_logger.error(f"Failed to reconcile guilds: {e}")
+
+        moved = await queries.assign_profile_slots(profile_slot)
+        if moved:
+            my_logger.info(f"Assigned time wheel slots to {moved} profiles")
+
+        await load_channel_cache()
+        await load_profile_index()
+        await load_film_cache()
+
+        try:
+            await start_metrics_server(METRICS_PORT)
+        except OSError as e:
+            my_logger.error(f"Failed to start metrics endpoint on port {METRICS_PORT}: {e}")
 
         # This section is to add profile urls to the database for users that were added before
         # I had added the 'profile_url' column to the database.
@@ -104,66 +113,44 @@ async def on_ready():
         #     else:
         #         my_logger.error(f"Failed to grab profile image for {user}")
 
-        synced = await bot.tree.sync()
-        my_logger.info(f"Synced {len(synced)} command(s)")
+        synced = await sync_command_tree(bot.tree)
+        if synced is None:
+            my_logger.info("Slash commands unchanged since the last sync")
+        else:
+            my_logger.info(f"Synced {len(synced)} command(s)")
         if not diary_loop.is_running():
             diary_loop.start()
     
     except Exception as e:
         my_logger.error(f"Error in on_ready event: {e}")
 
-    finally:
-        if cur: cur.close()
-        if conn: conn.close()
-
 
 # Initialize server info into database when joining a new server
 # Can fail if the bot joins a server while offline, on_ready() is used as a backup in this scenario
 @bot.event
 async def on_guild_join(guild):
     guild_id = guild.id
-    conn = None
-    cur = None
     my_logger.info(f"Joined new server: {guild.name} - {guild_id}")
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        query = """INSERT INTO discord_servers (server_id, user_count, updated_at)
-        VALUES (%s, %s, now())
-        ON CONFLICT (server_id) DO NOTHING;"""
-        cur.execute(query, (guild_id, 0))
-        conn.commit()
+        await queries.add_guild(guild_id)
 
     except psycopg2.Error as e:
         my_logger.error(f"Failed to add server {guild.name}, {guild_id} to database: {e}")
 
-    finally:
-        if cur: cur.close()
-        if conn: conn.close()
-
 
 # Deletes server info in database with cascading to other data tables when removed from a server
 @bot.event
 async def on_guild_remove(guild):
     guild_id = guild.id
-    conn = None
-    cur = None
     my_logger.info(f"Removed from server: {guild.name} - {guild_id}")
+    uncache_channel(guild_id)
+    unindex_guild(guild_id)
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        delete_query = """DELETE FROM discord_servers
-        WHERE server_id = %s;"""
-        cur.execute(delete_query, (guild_id,))
-        conn.commit()
+        await queries.remove_guild(guild_id)
     
     except psycopg2.Error as e:
         my_logger.error(f"Failed to remove server {guild.name}, {guild_id} to database: {e}")
 
-    finally:
-        if cur: cur.close()
-        if conn: conn.close()
-
 
 # Help command to list all bot commands and their descriptions
 @bot.tree.command(name="help", description="List all bot commands and their descriptions.")
@@ -235,13 +222,11 @@ async def help_command(interaction: discord.Interaction):
 async def add(interaction: discord.Interaction, arg: str):
     guild_id = interaction.guild.id
     channel_id = interaction.channel.id
-    conn = None
-    cur = None
     profile_name = arg.lower()
     profile_url = f"https://letterboxd.com/{profile_name}/"
     
     # Check if the command is used in the correct channel
-    channel_check, stored_channel_id = check_channel(channel_id, guild_id)
+    channel_check, stored_channel_id = await check_channel(channel_id, guild_id)
     if channel_check == "no_exist":
         await interaction.response.send_message("❗ Bot is not configured for this server yet. Use `/setchannel` first.", ephemeral=True)
         return
@@ -254,69 +239,56 @@ async def add(interaction: discord.Interaction, arg: str):
         await interaction.response.send_message(f"❌ Failed to get {profile_name} Letterboxd data, make sure input is a valid profile.")
         return
     
+    # Scraping the feed can take longer than Discord's 3 second window, even with priority over the task loop's requests
+    await interaction.response.defer(thinking=True)
+
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        get_query = """SELECT user_count
-        FROM discord_servers
-        WHERE server_id = %s"""
-        cur.execute(get_query, (guild_id,))
-        
-        users_count = cur.fetchone()
-        if users_count[0] >= MAX_USER_COUNT_PER_SERVER:
-            cur.close()
-            conn.close()
-            await interaction.response.send_message(f"❌ Failed to add {profile_name} to list. List exceeds maximum limit ({MAX_USER_COUNT_PER_SERVER}). First remove a user with `/remove`")
+        users_count = await queries.get_user_count(guild_id)
+        if users_count >= MAX_USER_COUNT_PER_SERVER:
+            await interaction.followup.send(f"❌ Failed to add {profile_name} to list. List exceeds maximum limit ({MAX_USER_COUNT_PER_SERVER}). First remove a user with `/remove`")
+            return
+
+        if await queries.is_tracked(profile_name, guild_id):
+            await interaction.followup.send(f"{arg} is already in the list")
             return
-        
-        insert_query = """INSERT INTO diary_users (profile_name, server_id, updated_at, profile_url)
-        VALUES (%s, %s, now(), %s)
-        ON CONFLICT (profile_name, server_id) DO NOTHING;"""
-        cur.execute(insert_query, (profile_name, guild_id, profile_url))
-
-        if cur.rowcount > 0:    # Checks if the insert_query execute before updating
-            result = firstScrape_rss(profile_name)
-            if not result or result[0] is False:
-                conn.rollback()
-                cur.close()
-                conn.close()
-                await interaction.response.send_message(f"❌ Failed to get {profile_name} Letterboxd data, make sure input is a valid profile.")
-                return
-            else:
-                if result[0] is True:
-                    profile_image = result[8]
-                    embed, film_title = build_embed_message(result, profile_url, profile_name, profile_image)
-                else:
-                    film_title, profile_image = result[0], result[1]
-            try:
-                server_update_query = """UPDATE discord_servers
-                SET user_count = user_count + 1, updated_at = now()
-                WHERE server_id = %s;"""
-                cur.execute(server_update_query, (guild_id,))
-                user_update_query = """UPDATE diary_users
-                SET last_entry = %s, updated_at = now(), profile_image = %s
-                WHERE profile_name = %s AND server_id = %s"""
-                cur.execute(user_update_query, (film_title, profile_image, profile_name, guild_id))
-            except psycopg2.Error as e:
-                my_logger.error(f"Error during /add transaction: {e}")
-                conn.rollback()
-            else:
-                conn.commit()
 
-            if film_title == "no_entry":
-                await interaction.response.send_message(f"✅ {arg} has been added to the list\n{arg} has no current entries.")
+        # The profile image comes from the avatar store, the profile page is only scraped for profiles nobody tracks yet
+        result = await asyncio.to_thread(firstScrape_rss, profile_name, False, True)
+        if not result or result[0] is False:
+            await interaction.followup.send(f"❌ Failed to get {profile_name} Letterboxd data, make sure input is a valid profile.")
+            return
+        else:
+            profile_image = await get_avatar(profile_name)
+            last_guid, last_pub_date = None, None
+            if result[0] is True:
+                last_guid, last_pub_date = result[9], result[10]
+                embed, film_title = build_embed_message(result[:9], profile_url, profile_name, profile_image)
             else:
-                await interaction.response.send_message(f"✅ {arg} has been added to the list\n{arg}'s most recent entry:\n",embed=embed[0])
+                film_title = result[0]
+
+        added = await queries.add_tracked_user(profile_name, guild_id, profile_url, film_title, profile_image, profile_slot(profile_name), last_guid, last_pub_date)
+        if not added:
+            await interaction.followup.send(f"{arg} is already in the list")
+            return
+
+        index_profile(guild_id, profile_name)
+        if film_title == "no_entry":
+            await interaction.followup.send(f"✅ {arg} has been added to the list\n{arg} has no current entries.")
         else:
-            await interaction.response.send_message(f"{arg} is already in the list")
+            await interaction.followup.send(f"✅ {arg} has been added to the list\n{arg}'s most recent entry:\n",embed=embed[0])
 
     except Exception as e:
         my_logger.error(f"Error in /add command: {e}")
-        await interaction.response.send_message("❌ Failed to add user: " + arg, ephemeral= True)
+        await interaction.followup.send("❌ Failed to add user: " + arg)
 
-    finally:
-        if cur: cur.close()
-        if conn: conn.close()
+# Suggests the server's own tracked profiles as the name is typed, all from memory so they come back well within Discord's window
+# For /add they're shown as already in the list, catching a duplicate before anything is scraped
+def profile_choices(interaction, current, label=""):
+    return [app_commands.Choice(name=f"{name}{label}", value=name) for name in complete_profiles(interaction.guild_id, current)]
+
+@add.autocomplete("arg")
+async def add_autocomplete(interaction: discord.Interaction, current: str):
+    return profile_choices(interaction, current, " (already in the list)")
 
 # Remove a user from the list/database if it exist
 @bot.tree.command(name="remove", description="Remove a user")
@@ -324,11 +296,9 @@ async def add(interaction: discord.Interaction, arg: str):
 async def remove(interaction: discord.interactions, arg: str):
     guild_id = interaction.guild_id
     channel_id = interaction.channel.id
-    conn = None
-    cur = None
     profile_name = arg.lower()
 
-    channel_check, stored_channel_id = check_channel(channel_id, guild_id)
+    channel_check, stored_channel_id = await check_channel(channel_id, guild_id)
     if channel_check == "no_exist":
         await interaction.response.send_message("❗ Bot is not configured for this server yet. Use `/setchannel` first.", ephemeral=True)
         return
@@ -341,25 +311,9 @@ async def remove(interaction: discord.interactions, arg: str):
         return
     
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        delete_query = """DELETE FROM diary_users
-        WHERE profile_name = %s AND server_id = %s"""
-        cur.execute(delete_query, (profile_name, guild_id))
-
-        if cur.rowcount > 0:    # Checks if the insert_query execute before updating
-            try:
-                update_query = """UPDATE discord_servers SET
-                user_count = user_count - 1, updated_at = now()
-                WHERE server_id = %s;"""
-                cur.execute(update_query, (guild_id,))
-            except psycopg2.Error as e:
-                my_logger.error(f"Error in /remove transaction: {e}")
-                conn.rollback()
-            else:
-                conn.commit()
-            finally:
-                await interaction.response.send_message(f"✅ {arg} has been removed from the list")
+        if await queries.remove_tracked_user(profile_name, guild_id):
+            unindex_profile(guild_id, profile_name)
+            await interaction.response.send_message(f"✅ {arg} has been removed from the list")
         else:
             await interaction.response.send_message(f"{arg} is not in the list")
 
@@ -367,9 +321,9 @@ async def remove(interaction: discord.interactions, arg: str):
         my_logger.error(f"Error in /remove: {e}")
         await interaction.response.send_message("❌ An error occurred while removing the user.", ephemeral=True)
 
-    finally:
-        if cur: cur.close()
-        if conn: conn.close()
+@remove.autocomplete("arg")
+async def remove_autocomplete(interaction: discord.Interaction, current: str):
+    return profile_choices(interaction, current)
 
 # Prints all users in the database for that server to the channel chat
 @bot.tree.command(name="list", description="List all users")
@@ -377,11 +331,9 @@ async def remove(interaction: discord.interactions, arg: str):
 async def list(interaction: discord.interactions):
     guild_id = interaction.guild.id
     channel_id = interaction.channel.id
-    conn = None
-    cur = None
     user_list = []
 
-    channel_check, stored_channel_id = check_channel(channel_id, guild_id)
+    channel_check, stored_channel_id = await check_channel(channel_id, guild_id)
     if channel_check == "no_exist":
         await interaction.response.send_message("❗ Bot is not configured for this server yet. Use `/setchannel` first.", ephemeral=True)
         return
@@ -390,18 +342,7 @@ async def list(interaction: discord.interactions):
         return
 
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        get_query = """SELECT profile_name, profile_url
-        FROM diary_users
-        WHERE server_id = %s"""
-        cur.execute(get_query, (guild_id,))
-        users = cur.fetchall()
-        count_query = """SELECT COUNT(profile_name)
-        FROM diary_users
-        WHERE server_id = %s"""
-        cur.execute(count_query, (guild_id,))
-        users_count = cur.fetchone()
+        users = await queries.list_tracked_users(guild_id)
 
         if not users:
             await interaction.response.send_message("No users have been added yet. Use `/add` to add users.")
@@ -412,7 +353,7 @@ async def list(interaction: discord.interactions):
             join_user_list = "\n".join(user_list)
 
             embed = Embed(
-            title=f"Users In This Server ({users_count[0]}/{MAX_USER_COUNT_PER_SERVER})",
+            title=f"Users In This Server ({len(users)}/{MAX_USER_COUNT_PER_SERVER})",
             description=join_user_list,
             color=0x1DB954
             )
@@ -422,10 +363,6 @@ async def list(interaction: discord.interactions):
         my_logger.error(f"Error printing list in: {e}")
         await interaction.response.send_message("❌ An error occurred while retrieving user list.", ephemeral=True)
 
-    finally:
-        if cur: cur.close()
-        if conn: conn.close()
-
 # Set the default channel for the bot's commands in the server
 # Stores channel id in the database
 @bot.tree.command(name="setchannel", description="Set the default channel (Text)")
@@ -433,36 +370,19 @@ async def list(interaction: discord.interactions):
 async def set_channel(interaction: discord.interactions, arg: TextChannel):
     guild_id = interaction.guild_id
     channel_id = arg.id
-    conn = None
-    cur = None
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        check_query = """SELECT 1 FROM server_channels WHERE server_id = %s"""
-        cur.execute(check_query, (guild_id,))
-        exists = cur.fetchone()
-        if exists:
+        status = await queries.set_server_channel(guild_id, channel_id)
+        if status == "exists":
             await interaction.response.send_message("❌ A default channel is already set for this server. Use `/updatechannel` to change it.", ephemeral=True)
+        elif status == "set":
+            cache_channel(guild_id, channel_id)
+            await interaction.response.send_message(f"✅ {arg} has been set as the default channel.")
         else:
-            insert_query = """INSERT INTO server_channels (channel_id, server_id, updated_at)
-            VALUES (%s, %s, now())
-            ON CONFLICT (channel_id, server_id) DO NOTHING"""
-            cur.execute(insert_query, (channel_id, guild_id))
-            if cur.rowcount > 0:
-                conn.commit()
-                await interaction.response.send_message(f"✅ {arg} has been set as the default channel.")
-            else:
-                conn.rollback()
-                await interaction.response.send_message(f"{arg} is already set as the default channel.")
+            await interaction.response.send_message(f"{arg} is already set as the default channel.")
         
     except Exception as e:
         my_logger.error(f"Error setting channel in {guild_id}: {e}")
         await interaction.response.send_message(f"❌ Failed to set {arg} as default channel.")
-    
-    finally:
-        if cur: cur.close()
-        if conn: conn.close()
 
 # Updates the stored channel to a different one
 @bot.tree.command(name="updatechannel", description="Change the default channel (Text)")
@@ -470,31 +390,17 @@ async def set_channel(interaction: discord.interactions, arg: TextChannel):
 async def update_channel(interaction: discord.interactions, arg: TextChannel):
     guild_id = interaction.guild_id
     channel_id = arg.id
-    conn = None
-    cur = None
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        update_query = """UPDATE server_channels
-        SET channel_id = %s, updated_at = now()
-        WHERE server_id = %s"""
-        cur.execute(update_query, (channel_id, guild_id))
-
-        if cur.rowcount > 0:
-            conn.commit()
+        if await queries.update_server_channel(guild_id, channel_id):
+            cache_channel(guild_id, channel_id)
             await interaction.response.send_message(f"✅ Default channel has been updated to {arg}")
         else:
-            conn.rollback()
             await interaction.response.send_message(f"No channel is set currently. Use `/setchannel` first.", ephemeral=True)
 
     except Exception as e:
         my_logger.error(f"Error updating channel in {guild_id}: {e}")
         await interaction.response.send_message(f"❌ Failed to update default channel to {arg}.")
 
-    finally:
-        if cur: cur.close()
-        if conn: conn.close()
-
 # Grabs the users' favorite films setup on their profile page
 @bot.tree.command(name="favorites", description="Grab users favorite films")
 @app_commands.describe(arg="Username: ")
@@ -504,13 +410,7 @@ async def favorite_films(interaction: discord.interactions, arg: str):
     profile_name = arg.lower()
     profile_url = f"https://letterboxd.com/{profile_name}/"
 
-    url = f"http://www.omdbapi.com/?apikey={api_key}&"
-    headers = {
-        "X-API-Key": api_key,
-        "Accept": "applications/json"
-    }
-
-    channel_check, stored_channel_id = check_channel(channel_id, guild_id)
+    channel_check, stored_channel_id = await check_channel(channel_id, guild_id)
     if channel_check == "no_exist":
         await interaction.response.send_message("❗ Bot is not configured for this server yet. Use `/setchannel` first.", ephemeral=True)
         return
@@ -518,14 +418,17 @@ async def favorite_films(interaction: discord.interactions, arg: str):
         await interaction.response.send_message(f"❌ Bot commands must be used in <#{stored_channel_id}>.", ephemeral=True)
         return
 
+    # Scraping the profile and the OMDb lookups can take longer than Discord's 3 second window
+    await interaction.response.defer(thinking=True)
+
     try:
-        results = favoriteFilmsScrape(arg)
+        results = await asyncio.to_thread(favoriteFilmsScrape, arg, True)
 
         if results == "No favorites":
-            await interaction.response.send_message(f"{arg} currently has no favorite films.")
+            await interaction.followup.send(f"{arg} currently has no favorite films.")
             return
         elif not results:
-            await interaction.response.send_message("Failed to find users favorite films. Check spelling or try again later.", ephemeral=True)
+            await interaction.followup.send("Failed to find users favorite films. Check spelling or try again later.")
             return
         
         titles = []
@@ -539,26 +442,13 @@ async def favorite_films(interaction: discord.interactions, arg: str):
             year = split_movie[1].strip(')')
             years.append(year)
 
-        try:    
-                for i in range(len(titles)):
-                    params = {
-                        "t": titles[i],
-                        "y": years[i],
-                        "type": "movie"
-                    }
-                    response = requests.get(url, headers=headers, params=params)
-                    data = response.json()
-
-                    if response.ok:
-                        movie_posters.append(data["Poster"])
-                    else:
-                        movie_titles.append(f"{titles[i]} ({years[i]})")
-                        my_logger.error(f"'/favorite' API call response returned false. Status Code: {response.status_code}")
-                        try:
-                            error_json = response.json()
-                            my_logger.error(f"Error Message: {error_json.get("message", "No message provided.")}")
-                        except ValueError:
-                            my_logger.error(f"Raw Error: {response.text}")   
+        try:
+            films = await get_films(zip(titles, years))
+            for i, data in enumerate(films):
+                if data and is_found(data):
+                    movie_posters.append(data["Poster"])
+                else:
+                    movie_titles.append(f"{titles[i]} ({years[i]})")
 
         except Exception as e:
             my_logger.error(f"Error in '/favorite' API call: {e}")
@@ -581,33 +471,27 @@ async def favorite_films(interaction: discord.interactions, arg: str):
             )
             embeds.append(title_embed)
         
-        await interaction.response.send_message(embeds=embeds)
+        await interaction.followup.send(embeds=embeds)
 
     except Exception as e:
         my_logger.error(f"Error in /favorites: {e}")
-        await interaction.response.send_message("Failed to find users favorite films. Check spelling or try again later.", ephemeral=True)
+        await interaction.followup.send("Failed to find users favorite films. Check spelling or try again later.")
+
+@favorite_films.autocomplete("arg")
+async def favorites_autocomplete(interaction: discord.Interaction, current: str):
+    return profile_choices(interaction, current)
 
 
 @bot.tree.command(name="film", description="Get a film's info")
 @app_commands.describe(arg="FilmName: ")
 async def film_search(interaction: discord.interactions, arg: str):
-    url = f"http://www.omdbapi.com/?apikey={api_key}&"
-    headers = {
-        "X-API-Key": api_key,
-        "Accept": "applications/json"
-    }
-    params = {
-        "t": arg,
-        "type": "movie"
-    }
-
     # Currently not restricing this command to the set channel
     # since I would like to be able to use this command anywhere.
     # May change later
     guild_id = interaction.guild.id
     channel_id = interaction.channel.id
 
-    channel_check, stored_channel_id = check_channel(channel_id, guild_id)
+    channel_check, stored_channel_id = await check_channel(channel_id, guild_id)
     if channel_check == "no_exist":
         await interaction.response.send_message("❗ Bot is not configured for this server yet. Use `/setchannel` first.", ephemeral=True)
         return
@@ -615,11 +499,13 @@ async def film_search(interaction: discord.interactions, arg: str):
         await interaction.response.send_message(f"❌ Bot commands must be used in <#{stored_channel_id}>.", ephemeral=True)
         return
 
+    # A cache miss waits on OMDb (up to OMDB_LOOKUP_TIMEOUT) and the cache write before it can answer
+    await interaction.response.defer(thinking=True)
+
     try:
-        response = requests.get(url, headers=headers, params=params)
-        data = response.json()
+        data = await get_film(arg)
 
-        if response.ok:
+        if data and is_found(data):
             embed = Embed(
                 title=f"{data["Title"]} ({data["Year"]})",
                 description=data["Plot"],
@@ -636,20 +522,13 @@ async def film_search(interaction: discord.interactions, arg: str):
 
             embed.set_footer(text=f"IMDb Rating: {data['imdbRating']}")
             
-            await interaction.response.send_message(embed=embed)
+            await interaction.followup.send(embed=embed)
         else:
-            my_logger.error(f"'/film' API call response returned false. Status Code: {response.status_code}")
-            try:
-                error_json = response.json()
-                my_logger.error(f"Error Message: {error_json.get("message", "No message provided.")}")
-            except ValueError:
-                my_logger.error(f"Raw Error: {response.text}")
-            finally:
-                await interaction.response.send_message("Failed to get film data. Check spelling or try again later.", ephemeral=True)
+            await interaction.followup.send("Failed to get film data. Check spelling or try again later.")
 
     except Exception as e:
         my_logger.error(f"Error in /film: {e}")
-        await interaction.response.send_message("Failed to get film data. Check spelling or try again later.", ephemeral=True)
+        await interaction.followup.send("Failed to get film data. Check spelling or try again later.")
 
 
 ### WORK IN PROGRESS ### Might not be possible
@@ -659,7 +538,7 @@ async def film_search(interaction: discord.interactions, arg: str):
 #     guild_id = interaction.guild.id
 #     channel_id = interaction.channel.id
 
-#     channel_check, stored_channel_id = check_channel(channel_id, guild_id)
+#     channel_check, stored_channel_id = await check_channel(channel_id, guild_id)
 #     if channel_check == "no_exist":
 #         await interaction.response.send_message("❗ Bot is not configured for this server yet. Use `/setchannel` first.", ephemeral=True)
 #         return
@@ -672,98 +551,20 @@ async def film_search(interaction: discord.interactions, arg: str):
 #     await interaction.response.send_message("This command is currently a work in progress")
 
 
-# Task loop set to perform every set interval
-# Grabs all users in the database and loops through each one to scrape their diary info
-# Scraping function is setup to scrape the 5 most recent entries, but will stop early if the stored 'last_entry'
-# is reached in the diary, so it will only return new entries compared to the 'last_entry'
-# Then will call update_last_entry() to update the 'last_entry' with the new title
-@tasks.loop(minutes=TASK_LOOP_INTERVAL)
+# Task loop runs once per time wheel slot (TASK_LOOP_INTERVAL / SCHEDULER_SLOTS minutes)
+# Every profile hashes to one slot, so each one is still checked once per TASK_LOOP_INTERVAL,
+# but the scraping and posting is spread evenly over the interval instead of bursting at the start
+# Profiles that haven't logged anything in a while are skipped for more turns, up to MAX_POLL_INTERVAL
+# Parsing stops at the stored watermark (guid and pubDate of the last entry posted), so it will only return
+# entries newer than that, up to DIARY_CATCH_UP_LIMIT of them
+# The new watermarks are buffered and written in bulk at the end of the loop
+# With SCRAPE_IN_WORKERS the scraping is done by worker.py processes, this loop only queues the polls and posts their results
+@tasks.loop(seconds=SLOT_SECONDS)
 async def diary_loop():
-    my_logger.info("Task loop has began.")
-
-    no_entry_users = {}
-    new_entry_users = {}
-    channel_cache = {}
-
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""SELECT sc.channel_id, sc.server_id, du.profile_name, du.last_entry, du.profile_url, du.profile_image
-                    FROM server_channels sc
-                    JOIN diary_users du ON sc.server_id = du.server_id""")
-        results = cur.fetchall()
-        cur.close()
-        conn.close()
-
-        for channel_id, server_id, profile_name, last_entry, profile_url, profile_image in results:
-            if profile_name in no_entry_users:
-                continue
-            
-            if channel_id in channel_cache:
-                channel = channel_cache[channel_id]
-            else:
-                try:
-                    channel = await bot.fetch_channel(channel_id)
-                    channel_cache[channel_id] = channel
-                except discord.NotFound:
-                    my_logger.warning(f"Channel {channel_id} not found.")
-                    continue
-                except discord.Forbidden:
-                    my_logger.warning(f"Missing permissions to access channel {channel_id} of server {server_id}")
-                    continue
-                except Exception as e:
-                    my_logger.error(f"Error fetching channel {channel_id}: {e}")
-                    continue
-            
-            if not isinstance(channel, discord.TextChannel):
-                my_logger.warning(f"Channel {channel_id} is not a text channel.")
-                continue
-
-            if profile_name not in new_entry_users:
-                await asyncio.sleep(random.randint(1, 3))  # To help with rate limiting issues, only when scraping
-
-                try:
-                    result = await asyncio.to_thread(diaryScrape_rss, profile_name, last_entry)
-                    if not result[0]:
-                        no_entry_users[profile_name] = server_id
-                        continue
-
-                    embed, film_title = await asyncio.to_thread(build_embed_message, result, profile_url, profile_name, profile_image)
-                    await asyncio.to_thread(update_last_entry, server_id, profile_name, film_title)
-                    new_entry_users[profile_name] = (embed, film_title)
-                
-                    for message in embed:
-                        await channel.send(embed=message)
-                        await asyncio.sleep(0.5)
-
-                except discord.NotFound:
-                    my_logger.warning(f"Channel {channel_id} not found.")
-                except discord.Forbidden:
-                    my_logger.warning(f"Missing permissions to send in channel {channel_id} of server {server_id}")
-                except Exception as e:
-                    my_logger.error(f"Error sending Task Loop message to {channel_id}, {profile_name}: {e}")
-            else:
-                try:
-                    embed, film_title = new_entry_users[profile_name]
-                    await asyncio.to_thread(update_last_entry, server_id, profile_name, film_title)
-                        
-                    for message in embed:
-                        await channel.send(embed=message)
-                        await asyncio.sleep(0.5)
-
-                except discord.NotFound:
-                    my_logger.warning(f"Channel {channel_id} not found.")
-                except discord.Forbidden:
-                    my_logger.warning(f"Missing permissions to send in channel {channel_id} of server {server_id}")
-                except Exception as e:
-                    my_logger.error(f"Error sending Task Loop message to {channel_id}, {profile_name}: {e}")
-
-    except Exception as e:
-        my_logger.error(f"Scheduled task failed: {e}")
-
-    my_logger.info("Task loop has finished.")
-    my_logger.debug(f"Users with no new entries this loop: {no_entry_users.keys()}")
-    my_logger.debug(f"Users with new entries this loop: {new_entry_users.keys()}")
+    slots = time_wheel.due_slots()
+    if not slots:
+        return
+    await run_diary_loop(slots, dispatcher)
 
 
 @diary_loop.before_loop
@@ -0,0 +1,133 @@
+import contextvars, logging, threading, time
+from contextlib import contextmanager
+from aiohttp import web
+
+my_logger = logging.getLogger("mybot")
+
+# In-process metrics for the diary task loop and the OMDb cache, served in Prometheus' text format on /metrics
+# Written by hand instead of pulling in prometheus_client, only counters and histograms with a single label are needed
+# Stages run both on the event loop and in worker threads (parsing, embeds, database), so every update takes a lock
+
+# Seconds the current task spent in each timed stage, only tracked when a dict has been set, see poller.poll_profiles()
+# Every asyncio task gets its own copy of the context, so concurrent polls don't add into each other's dicts
+stage_time = contextvars.ContextVar("stage_time", default=None)
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)  # in seconds
+
+
+def format_labels(label, value, extra=""):
+    labels = f'{label}="{value}"' if label else ""
+    if extra:
+        labels = f"{labels},{extra}" if labels else extra
+    return f"{{{labels}}}" if labels else ""
+
+
+class Counter:
+    def __init__(self, name, description, label=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.values = {}    # label value -> count
+        self.lock = threading.Lock()
+
+    def inc(self, value=None, amount=1):
+        with self.lock:
+            self.values[value] = self.values.get(value, 0) + amount
+
+    def get(self, value=None):
+        with self.lock:
+            return self.values.get(value, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for value, count in sorted(self.values.items(), key=lambda item: str(item[0])):
+                lines.append(f"{self.name}{format_labels(self.label, value)} {count}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, label=None, buckets=STAGE_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+        self.values = {}    # label value -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, seconds):
+        with self.lock:
+            series = self.values.setdefault(value, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+            series[-2] += seconds
+            series[-1] += 1
+        spent = stage_time.get()
+        if spent is not None:
+            spent[value] = spent.get(value, 0) + seconds
+
+    # Times the 'with' block, awaiting inside it is fine, the time spent suspended counts towards the stage
+    @contextmanager
+    def time(self, value=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(value, time.perf_counter() - started)
+
+    # Sum of every observation of one label value so far
+    def total(self, value=None):
+        with self.lock:
+            series = self.values.get(value)
+            return series[-2] if series else 0.0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for value, series in sorted(self.values.items(), key=lambda item: str(item[0])):
+                for bound, count in zip(self.buckets + ("+Inf",), series[:-2] + [series[-1]]):
+                    le = f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{format_labels(self.label, value, le)} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.label, value)} {series[-2]}")
+                lines.append(f"{self.name}_count{format_labels(self.label, value)} {series[-1]}")
+        return lines
+
+
+# Stages: tick (the whole loop), fetch_feed, connection_wait (part of fetch_feed), parse, build_embeds,
+# update_last_entries, fetch_channel, send
+STAGE_SECONDS = Histogram("diary_stage_seconds", "Time spent in each stage of the diary task loop", "stage")
+# Outcomes: new, none (feed fetched, nothing new), error, 404
+SCRAPE_OUTCOMES = Counter("diary_scrape_outcomes_total", "Diary feed polls by outcome", "outcome")
+# Results: sent, retried, dead (gave up and dead-lettered)
+SENDS = Counter("diary_sends_total", "Diary message sends by result", "result")
+# Results: hit, miss
+OMDB_CACHE_LOOKUPS = Counter("omdb_cache_lookups_total", "OMDb cache lookups by result", "result")
+
+registry = [STAGE_SECONDS, SCRAPE_OUTCOMES, SENDS, OMDB_CACHE_LOOKUPS]
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics(request):
+    return web.Response(body=render().encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+# Serves /metrics on the bot's own event loop, started once from on_ready()
+runner = None
+
+async def start_metrics_server(port):
+    global runner
+    if runner is not None or port is None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    my_logger.info(f"Serving metrics on port {port}")
@@ -0,0 +1,137 @@
+import aiohttp, asyncio, logging, threading, time
+from collections import OrderedDict
+from config import api_key, OMDB_CACHE_SIZE, OMDB_CACHE_TTL, OMDB_NEGATIVE_CACHE_TTL, OMDB_LOOKUP_TIMEOUT
+from metrics import OMDB_CACHE_LOOKUPS
+import queries
+
+my_logger = logging.getLogger("mybot")
+
+OMDB_URL = "http://www.omdbapi.com/"
+
+
+# Bounded LRU of OMDb responses keyed on the normalized (title, year, type) of the lookup
+# "Movie not found" answers are cached too, with a shorter TTL, so repeated typos don't burn API quota
+# Hits and misses are also counted on /metrics, see metrics.OMDB_CACHE_LOOKUPS
+class OmdbCache:
+    def __init__(self, max_size, ttl, negative_ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()    # key -> (expires_at, payload)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Returns the cached payload, or None on a miss
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                OMDB_CACHE_LOOKUPS.inc("hit")
+                return entry[1]
+            if entry:
+                del self.entries[key]
+            self.misses += 1
+            OMDB_CACHE_LOOKUPS.inc("miss")
+            return None
+
+    def set(self, key, payload, age=0):
+        ttl = self.ttl if is_found(payload) else self.negative_ttl
+        if age >= ttl:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl - age, payload)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self.entries),
+            }
+
+
+film_cache = OmdbCache(OMDB_CACHE_SIZE, OMDB_CACHE_TTL, OMDB_NEGATIVE_CACHE_TTL)
+
+
+def cache_key(title, year=None, type="movie"):
+    normalized_title = " ".join(title.casefold().split())
+    return f"{type}|{normalized_title}|{(year or '').strip()}"
+
+def is_found(payload):
+    return payload.get("Response") == "True"
+
+# Only "not found" answers are worth remembering, errors like a hit request limit are temporary
+def is_cacheable(payload):
+    return is_found(payload) or "not found" in payload.get("Error", "").lower()
+
+
+# Shared aiohttp session for OMDb, created on first use inside the bot's event loop
+session = None
+
+def get_session():
+    global session
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            headers={"X-API-Key": api_key, "Accept": "applications/json"},
+            timeout=aiohttp.ClientTimeout(total=OMDB_LOOKUP_TIMEOUT)
+        )
+    return session
+
+
+# Returns the JSON payload or None if the call itself failed
+async def fetch_film(title, year=None, type="movie"):
+    params = {
+        "apikey": api_key,
+        "t": title,
+        "type": type
+    }
+    if year:
+        params["y"] = year
+
+    try:
+        async with get_session().get(OMDB_URL, params=params) as response:
+            if response.status != 200:
+                my_logger.error(f"OMDb API call response returned false. Status Code: {response.status}")
+                my_logger.error(f"Raw Error: {(await response.text())[:500]}")
+                return None
+            return await response.json(content_type=None)
+    except Exception as e:
+        my_logger.error(f"Error in OMDb API call for {title} ({year}): {e!r}")
+        return None
+
+
+# Cached OMDb lookup used by /film and /favorites
+# Returns the OMDb payload (check is_found() before using its fields) or None if OMDb couldn't be reached in time
+async def get_film(title, year=None, type="movie"):
+    key = cache_key(title, year, type)
+    payload = film_cache.get(key)
+    if payload is not None:
+        return payload
+
+    payload = await fetch_film(title, year, type)
+    if payload is not None and is_cacheable(payload):
+        film_cache.set(key, payload)
+        await queries.save_omdb_entry(key, payload)
+    return payload
+
+
+# Looks up every (title, year) at once, so a batch takes about as long as its slowest lookup
+async def get_films(films):
+    return await asyncio.gather(*(get_film(title, year) for title, year in films))
+
+
+# Warms the in-memory cache from the omdb_cache table so a restart doesn't start cold
+async def load_film_cache():
+    rows = await queries.load_omdb_cache(OMDB_CACHE_SIZE, OMDB_CACHE_TTL)
+    # Oldest first so the newest entries end up at the most recently used end of the LRU
+    for key, payload, age in reversed(rows):
+        film_cache.set(key, payload, float(age))
+    my_logger.info(f"Loaded {film_cache.stats()['size']} OMDb cache entries")
@@ -0,0 +1,146 @@
+import aiohttp, asyncio, logging, time
+from config import MAX_CONCURRENT_REQUESTS_PER_HOST, REQUEST_TIMEOUT
+from scraping import headers, fetchFeed_rss, diaryParse_rss, parsePubDate
+from helper import build_embed_message
+from metrics import STAGE_SECONDS, SCRAPE_OUTCOMES, stage_time
+import queries
+
+my_logger = logging.getLogger("mybot")
+
+
+# One session per task loop run, the connector caps how many requests can be open to letterboxd.com at once
+# No total timeout, time spent queued for a free connection shouldn't count against a request
+def create_session():
+    connector = aiohttp.TCPConnector(limit_per_host=MAX_CONCURRENT_REQUESTS_PER_HOST)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=REQUEST_TIMEOUT, sock_read=REQUEST_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers, trace_configs=[connection_wait_trace()])
+
+
+# The fetch_feed stage includes the time a request spends queued for a free connection,
+# this records that part on its own so a slow Letterboxd and a too small connection limit can be told apart
+def connection_wait_trace():
+    async def queued_start(session, context, params):
+        context.queued_at = time.perf_counter()
+
+    async def queued_end(session, context, params):
+        STAGE_SECONDS.observe("connection_wait", time.perf_counter() - context.queued_at)
+
+    trace = aiohttp.TraceConfig()
+    trace.on_connection_queued_start.append(queued_start)
+    trace.on_connection_queued_end.append(queued_end)
+    return trace
+
+
+# Fetches one feed with its stored validators and only parses it when the body actually changed
+# Also returns the (guid, pubDate) of the items that were parsed, newest first, for the watermark and the poll schedule
+async def poll_profile(session, profile_name, watermark, validators):
+    status, body, new_validators = await fetchFeed_rss(session, profile_name, validators)
+    size = len(body) if body else 0
+    seen = []
+    if status != "modified":
+        # Failed fetches were already counted by fetchFeed_rss(), with their status code
+        if status:
+            SCRAPE_OUTCOMES.inc("none")
+        return status, (False, None), new_validators, size, seen
+
+    with STAGE_SECONDS.time("parse"):
+        result = await asyncio.to_thread(diaryParse_rss, body, profile_name, watermark, seen)
+    SCRAPE_OUTCOMES.inc("new" if result[0] else "none")
+    return status, result, new_validators, size, seen
+
+
+# Scrapes every profile's RSS feed concurrently
+# 'profiles' is a dict of profile_name -> watermark, 'validators' is a dict of profile_name -> (etag, last_modified, body_hash)
+# Returns a dict of profile_name -> diaryParse_rss result, the validators that changed this run, cache stats,
+# and a dict of profile_name -> (guid, pubDate) of the items seen for every profile that was polled successfully
+# If a 'timings' dict is passed, it gets profile_name -> seconds spent fetching and parsing that profile's feed,
+# not counting the time spent waiting on the rate limiter or for a free connection
+async def poll_profiles(profiles, validators, timings=None):
+    polled = {}
+    changed_validators = {}
+    activity = {}
+    stats = new_cache_stats()
+    if not profiles:
+        return polled, changed_validators, stats, activity
+
+    async def timed_poll(session, profile_name, watermark):
+        spent = {}
+        stage_time.set(spent)
+        try:
+            return await poll_profile(session, profile_name, watermark, validators.get(profile_name))
+        finally:
+            if timings is not None:
+                timings[profile_name] = spent.get("fetch_feed", 0) - spent.get("connection_wait", 0) + spent.get("parse", 0)
+
+    async with create_session() as session:
+        tasks = [timed_poll(session, profile_name, watermark) for profile_name, watermark in profiles.items()]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    for profile_name, outcome in zip(profiles, results):
+        if isinstance(outcome, BaseException):
+            my_logger.error(f"Error polling {profile_name}: {outcome}")
+            polled[profile_name] = (False, None)
+            stats["failed"] += 1
+            SCRAPE_OUTCOMES.inc("error")
+            continue
+
+        status, result, new_validators, size, seen = outcome
+        polled[profile_name] = result
+        stats[status or "failed"] += 1
+        stats["bytes"] += size
+        if status:
+            activity[profile_name] = seen
+        if status and new_validators != validators.get(profile_name):
+            changed_validators[profile_name] = new_validators
+
+    return polled, changed_validators, stats, activity
+
+
+def new_cache_stats():
+    return {"not_modified": 0, "unchanged": 0, "modified": 0, "failed": 0, "bytes": 0}
+
+
+# Loads the poll schedule and stored feed validators of the given profiles
+# Profiles without a schedule yet get no validators, so they're fetched in full and their activity can be read from the feed
+async def load_validators(profile_names):
+    schedule = await queries.load_poll_schedule(profile_names)
+    validators = await queries.load_feed_validators(schedule) if schedule else {}
+    return schedule, validators
+
+
+# Builds the embeds of every profile with new entries, with the profile url and image of its first diary row
+# Returns a dict of profile_name -> (embeds, latest film title, (guid, pubDate) of the latest entry)
+async def build_messages(polled, rows, activity):
+    prepared = {}
+    for _, _, profile_name, _, profile_url, profile_image in rows:
+        result = polled.get(profile_name)
+        if profile_name in prepared or not result or not result[0]:
+            continue
+        with STAGE_SECONDS.time("build_embeds"):
+            built = await asyncio.to_thread(build_embed_message, result, profile_url, profile_name, profile_image)
+        if built:
+            guid, pub_date = activity[profile_name][0]
+            prepared[profile_name] = (*built, (guid, parsePubDate(pub_date)))
+    return prepared
+
+
+# Profiles stored before the guid watermark get one the first time a poll reads their feed
+# When there were no new entries, the first item read is the one that matched their last film title
+# Returns a dict of profile_name -> (last_entry, guid, pubDate)
+def upgrade_watermarks(rows, prepared, activity):
+    upgrades = {}
+    for _, _, profile_name, (last_guid, last_pub_date, last_entry), _, _ in rows:
+        seen = activity.get(profile_name)
+        if last_guid or last_pub_date or profile_name in prepared or not seen:
+            continue
+        guid, pub_date = seen[0]
+        upgrades[profile_name] = (last_entry, guid, parsePubDate(pub_date))
+    return upgrades
+
+
+# Share of feeds this run that didn't need to be parsed
+def cache_hit_rate(stats):
+    total = stats["not_modified"] + stats["unchanged"] + stats["modified"] + stats["failed"]
+    if not total:
+        return 0.0
+    return (stats["not_modified"] + stats["unchanged"]) / total
@@ -0,0 +1,711 @@
+import asyncio, functools, logging, psycopg2
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import execute_values, Json
+from config import DB_POOL_MAX_SIZE
+from database import get_db_connection
+from metrics import STAGE_SECONDS
+
+my_logger = logging.getLogger("mybot")
+
+# psycopg2 is blocking, so every query below runs on its own thread pool, sized to the connection pool
+# Keeps a slow query from holding up the gateway, and keeps DB work from queueing behind scraping threads
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX_SIZE, thread_name_prefix="db")
+
+
+def run_in_db_thread(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+    return wrapper
+
+
+### discord_servers ###
+
+# Makes discord_servers match the guilds the bot is in, for joins and removals missed while it was offline
+# Missing guilds are inserted and guilds the bot left are deleted (cascading to their channel and subscriptions),
+# along with any profile no other server tracks anymore, all in one transaction with the same few statements
+# however many guilds there are. Returns (added ids, removed ids)
+# An empty guild list removes nothing, that's more likely a startup hiccup than the bot being in no servers at all
+@run_in_db_thread
+def reconcile_guilds(guild_ids):
+    guild_ids = list(guild_ids)
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """INSERT INTO discord_servers (server_id, user_count, updated_at)
+            SELECT server_id, 0, now() FROM unnest(%s::bigint[]) AS server_id
+            ON CONFLICT (server_id) DO NOTHING
+            RETURNING server_id""",
+            (guild_ids,)
+        )
+        added = [row[0] for row in cur.fetchall()]
+
+        removed = []
+        if guild_ids:
+            cur.execute(
+                """WITH stale AS (
+                    SELECT server_id FROM discord_servers WHERE server_id <> ALL(%s::bigint[])
+                ), dropped AS (
+                    SELECT DISTINCT profile_name FROM profile_subscriptions WHERE server_id IN (SELECT server_id FROM stale)
+                ), removed AS (
+                    DELETE FROM discord_servers WHERE server_id IN (SELECT server_id FROM stale) RETURNING server_id
+                )
+                SELECT (SELECT array_agg(server_id) FROM removed), (SELECT array_agg(profile_name) FROM dropped)""",
+                (guild_ids,)
+            )
+            removed_ids, dropped_profiles = cur.fetchone()
+            removed = removed_ids or []
+            if dropped_profiles:
+                cur.execute(
+                    """DELETE FROM profiles p
+                    WHERE p.profile_name = ANY(%s)
+                    AND NOT EXISTS (SELECT 1 FROM profile_subscriptions ps WHERE ps.profile_name = p.profile_name)""",
+                    (dropped_profiles,)
+                )
+        conn.commit()
+    return added, removed
+
+@run_in_db_thread
+def add_guild(guild_id):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        query = """INSERT INTO discord_servers (server_id, user_count, updated_at)
+        VALUES (%s, %s, now())
+        ON CONFLICT (server_id) DO NOTHING;"""
+        cur.execute(query, (guild_id, 0))
+        conn.commit()
+
+# Deleting the server cascades to its channel and tracked users
+# Profiles no other server tracks are dropped with it, like in remove_tracked_user()
+@run_in_db_thread
+def remove_guild(guild_id):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT profile_name FROM profile_subscriptions WHERE server_id = %s", (guild_id,))
+        profile_names = [row[0] for row in cur.fetchall()]
+
+        delete_query = """DELETE FROM discord_servers
+        WHERE server_id = %s;"""
+        cur.execute(delete_query, (guild_id,))
+
+        if profile_names:
+            orphan_query = """DELETE FROM profiles p
+            WHERE p.profile_name = ANY(%s)
+            AND NOT EXISTS (SELECT 1 FROM profile_subscriptions ps WHERE ps.profile_name = p.profile_name)"""
+            cur.execute(orphan_query, (profile_names,))
+        conn.commit()
+
+@run_in_db_thread
+def get_user_count(guild_id):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        get_query = """SELECT user_count
+        FROM discord_servers
+        WHERE server_id = %s"""
+        cur.execute(get_query, (guild_id,))
+        row = cur.fetchone()
+    return row[0] if row else 0
+
+
+### server_channels ###
+
+# Returns the channel id set with /setchannel, or None if there isn't one
+@run_in_db_thread
+def get_server_channel(guild_id):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        select_query = """SELECT channel_id
+        FROM server_channels
+        WHERE server_id = %s"""
+        cur.execute(select_query, (guild_id,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+# Returns a dict of server_id -> channel_id for every server with a channel set
+@run_in_db_thread
+def get_all_server_channels():
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT server_id, channel_id FROM server_channels")
+        return dict(cur.fetchall())
+
+# Returns "exists" if the server already has a channel, "duplicate" if this exact channel is already set, otherwise "set"
+@run_in_db_thread
+def set_server_channel(guild_id, channel_id):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        check_query = """SELECT 1 FROM server_channels WHERE server_id = %s"""
+        cur.execute(check_query, (guild_id,))
+        if cur.fetchone():
+            return "exists"
+
+        insert_query = """INSERT INTO server_channels (channel_id, server_id, updated_at)
+        VALUES (%s, %s, now())
+        ON CONFLICT (channel_id, server_id) DO NOTHING"""
+        cur.execute(insert_query, (channel_id, guild_id))
+        if cur.rowcount > 0:
+            conn.commit()
+            return "set"
+        return "duplicate"
+
+# Returns False if the server has no channel set yet
+@run_in_db_thread
+def update_server_channel(guild_id, channel_id):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        update_query = """UPDATE server_channels
+        SET channel_id = %s, updated_at = now()
+        WHERE server_id = %s"""
+        cur.execute(update_query, (channel_id, guild_id))
+        if cur.rowcount > 0:
+            conn.commit()
+            return True
+        return False
+
+
+### profiles / profile_subscriptions ###
+
+@run_in_db_thread
+def is_tracked(profile_name, guild_id):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM profile_subscriptions WHERE profile_name = %s AND server_id = %s", (profile_name, guild_id))
+        return cur.fetchone() is not None
+
+# Subscribes the server to the profile and bumps the server's user count in one transaction
+# A profile another server already tracks keeps its watermark and image fetch time, only its url and image are refreshed
+# A leftover row nobody subscribes to takes the fresh watermark and loses its old poll schedule and validators,
+# otherwise entries logged since it was last polled would be posted to this server as new
+# Returns False if the user was already in the list
+@run_in_db_thread
+def add_tracked_user(profile_name, guild_id, profile_url, last_entry, profile_image, slot, last_guid=None, last_pub_date=None):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM profile_subscriptions WHERE profile_name = %s LIMIT 1", (profile_name,))
+        shared = cur.fetchone() is not None
+        if not shared:
+            cur.execute("DELETE FROM poll_schedule WHERE profile_name = %s", (profile_name,))
+            cur.execute("DELETE FROM feed_cache WHERE profile_name = %s", (profile_name,))
+
+        profile_query = """INSERT INTO profiles (profile_name, profile_url, last_entry, profile_image, slot, last_guid, last_pub_date, image_fetched_at, updated_at)
+        VALUES (%(profile_name)s, %(profile_url)s, %(last_entry)s, %(profile_image)s, %(slot)s, %(last_guid)s, %(last_pub_date)s, now(), now())
+        ON CONFLICT (profile_name) DO UPDATE
+        SET profile_url = EXCLUDED.profile_url, profile_image = COALESCE(EXCLUDED.profile_image, profiles.profile_image), updated_at = now(),
+            last_entry = CASE WHEN %(shared)s THEN profiles.last_entry ELSE EXCLUDED.last_entry END,
+            last_guid = CASE WHEN %(shared)s THEN profiles.last_guid ELSE EXCLUDED.last_guid END,
+            last_pub_date = CASE WHEN %(shared)s THEN profiles.last_pub_date ELSE EXCLUDED.last_pub_date END;"""
+        cur.execute(profile_query, {"profile_name": profile_name, "profile_url": profile_url, "last_entry": last_entry, "profile_image": profile_image,
+                                    "slot": slot, "last_guid": last_guid, "last_pub_date": last_pub_date, "shared": shared})
+
+        subscription_query = """INSERT INTO profile_subscriptions (profile_name, server_id)
+        VALUES (%s, %s)
+        ON CONFLICT (profile_name, server_id) DO NOTHING;"""
+        cur.execute(subscription_query, (profile_name, guild_id))
+        if cur.rowcount == 0:
+            return False
+
+        server_update_query = """UPDATE discord_servers
+        SET user_count = user_count + 1, updated_at = now()
+        WHERE server_id = %s;"""
+        cur.execute(server_update_query, (guild_id,))
+        conn.commit()
+        return True
+
+# Returns False if the user wasn't in the list
+# The profile itself is dropped once no server subscribes to it anymore, taking its poll schedule and feed validators with it
+@run_in_db_thread
+def remove_tracked_user(profile_name, guild_id):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        delete_query = """DELETE FROM profile_subscriptions
+        WHERE profile_name = %s AND server_id = %s"""
+        cur.execute(delete_query, (profile_name, guild_id))
+        if cur.rowcount == 0:
+            return False
+
+        orphan_query = """DELETE FROM profiles
+        WHERE profile_name = %s
+        AND NOT EXISTS (SELECT 1 FROM profile_subscriptions WHERE profile_name = %s)"""
+        cur.execute(orphan_query, (profile_name, profile_name))
+
+        update_query = """UPDATE discord_servers SET
+        user_count = user_count - 1, updated_at = now()
+        WHERE server_id = %s;"""
+        cur.execute(update_query, (guild_id,))
+        conn.commit()
+        return True
+
+# Returns (profile_image, is_stale) for a profile some server already tracks, or None for a new profile
+# An image older than 'max_age' seconds, or one that was never found, counts as stale
+@run_in_db_thread
+def get_profile_image(profile_name, max_age):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """SELECT profile_image,
+                profile_image IS NULL OR image_fetched_at IS NULL
+                OR image_fetched_at < now() - make_interval(secs => %s)
+            FROM profiles
+            WHERE profile_name = %s""",
+            (max_age, profile_name)
+        )
+        return cur.fetchone()
+
+# Returns up to 'limit' profile names whose image is stale, longest stale first
+@run_in_db_thread
+def get_stale_profile_images(max_age, limit):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """SELECT profile_name
+            FROM profiles
+            WHERE profile_image IS NULL OR image_fetched_at IS NULL
+            OR image_fetched_at < now() - make_interval(secs => %s)
+            ORDER BY image_fetched_at NULLS FIRST
+            LIMIT %s""",
+            (max_age, limit)
+        )
+        return [row[0] for row in cur.fetchall()]
+
+# 'rows' is a list of (profile_name, profile_image), a None image keeps the old one but still counts as a fetch
+# so a profile whose page fails isn't retried on every run
+@run_in_db_thread
+def update_profile_images(rows):
+    if not rows:
+        return
+    try:
+        with get_db_connection() as conn, conn.cursor() as cur:
+            execute_values(
+                cur,
+                """UPDATE profiles AS p
+                SET profile_image = COALESCE(v.profile_image, p.profile_image), image_fetched_at = now(), updated_at = now()
+                FROM (VALUES %s) AS v(profile_name, profile_image)
+                WHERE p.profile_name = v.profile_name""",
+                rows,
+                template="(%s, %s::text)",
+                page_size=len(rows)
+            )
+            conn.commit()
+    except psycopg2.Error as e:
+        my_logger.error(f"Error updating profile images: {e}")
+
+# Every (server_id, profile_name) subscription, used to build the autocomplete index at startup
+@run_in_db_thread
+def get_all_subscriptions():
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT server_id, profile_name FROM profile_subscriptions")
+        return cur.fetchall()
+
+# Returns a list of (profile_name, profile_url) for the server
+@run_in_db_thread
+def list_tracked_users(guild_id):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        get_query = """SELECT p.profile_name, p.profile_url
+        FROM profile_subscriptions ps
+        JOIN profiles p ON p.profile_name = ps.profile_name
+        WHERE ps.server_id = %s"""
+        cur.execute(get_query, (guild_id,))
+        return cur.fetchall()
+
+# Stores every profile's time wheel slot, 'slot_of' maps a profile name to its slot (scheduler.profile_slot)
+# Run on startup, it fills in profiles stored before the slot column and moves everyone after SCHEDULER_SLOTS changes
+# Returns how many profiles got a new slot
+@run_in_db_thread
+def assign_profile_slots(slot_of):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT profile_name, slot FROM profiles")
+        rows = [(profile_name, slot_of(profile_name)) for profile_name, slot in cur.fetchall() if slot != slot_of(profile_name)]
+        if rows:
+            execute_values(
+                cur,
+                """UPDATE profiles AS p
+                SET slot = v.slot
+                FROM (VALUES %s) AS v(profile_name, slot)
+                WHERE p.profile_name = v.profile_name""",
+                rows,
+                template="(%s, %s::smallint)",
+                page_size=1000
+            )
+        conn.commit()
+        return len(rows)
+
+# Diary rows come out as (channel_id, server_id, profile_name, watermark, profile_url, profile_image)
+# with the watermark being (last_guid, last_pub_date, last_entry)
+def diary_rows(rows):
+    return [(channel_id, server_id, profile_name, (last_guid, last_pub_date, last_entry), profile_url, profile_image)
+            for channel_id, server_id, profile_name, last_guid, last_pub_date, last_entry, profile_url, profile_image in rows]
+
+# Every (channel, tracked user) pair the task loop has to check for the profiles in the given time wheel 'slots'
+# Profiles whose next poll is more than 'due_within' seconds away are left out
+@run_in_db_thread
+def get_diary_rows(slots, due_within=0):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute("""SELECT sc.channel_id, sc.server_id, p.profile_name, p.last_guid, p.last_pub_date, p.last_entry, p.profile_url, p.profile_image
+                    FROM profiles p
+                    JOIN profile_subscriptions ps ON ps.profile_name = p.profile_name
+                    JOIN server_channels sc ON sc.server_id = ps.server_id
+                    LEFT JOIN poll_schedule sch ON sch.profile_name = p.profile_name
+                    WHERE p.slot = ANY(%s::smallint[])
+                    AND (sch.next_poll_at IS NULL OR sch.next_poll_at <= now() + make_interval(secs => %s))""",
+                    (list(slots), due_within))
+        return diary_rows(cur.fetchall())
+
+# Same rows as get_diary_rows() but only for the given profiles, used to post results that came back from the workers
+@run_in_db_thread
+def get_diary_rows_for(profile_names):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute("""SELECT sc.channel_id, sc.server_id, p.profile_name, p.last_guid, p.last_pub_date, p.last_entry, p.profile_url, p.profile_image
+                    FROM server_channels sc
+                    JOIN profile_subscriptions ps ON ps.server_id = sc.server_id
+                    JOIN profiles p ON p.profile_name = ps.profile_name
+                    WHERE p.profile_name = ANY(%s)""",
+                    (list(profile_names),))
+        return diary_rows(cur.fetchall())
+
+# Stores the profiles' most recent entry in their letterboxd diary into the database
+# 'rows' is a list of (profile_name, last_entry, last_guid, last_pub_date), all written with one UPDATE in one transaction
+# Returns False if the write failed
+@run_in_db_thread
+def update_last_entries(rows):
+    if not rows:
+        return True
+    try:
+        with STAGE_SECONDS.time("update_last_entries"), get_db_connection() as conn, conn.cursor() as cur:
+            execute_values(
+                cur,
+                """UPDATE profiles AS p
+                SET last_entry = v.last_entry, last_guid = v.last_guid, last_pub_date = v.last_pub_date, updated_at = now()
+                FROM (VALUES %s) AS v(profile_name, last_entry, last_guid, last_pub_date)
+                WHERE p.profile_name = v.profile_name""",
+                rows,
+                template="(%s, %s, %s, %s::timestamptz)",
+                page_size=len(rows)
+            )
+            conn.commit()
+        return True
+    except psycopg2.Error as e:
+        my_logger.error(f"Error in diary loop update query: {e}")
+        return False
+
+
+# Collects the task loop's watermark changes and writes them in bulk
+# Commits in chunks of 'flush_size' so a big tick doesn't hold everything until the very end
+# Profiles whose chunk failed to commit are kept in 'failed', so the loop can leave their validators and schedule alone
+class LastEntryBatch:
+    def __init__(self, flush_size):
+        self.flush_size = flush_size
+        self.rows = {}
+        self.written = 0
+        self.failed = set()
+
+    async def add(self, profile_name, last_entry, last_guid, last_pub_date):
+        self.rows[profile_name] = (last_entry, last_guid, last_pub_date)
+        if len(self.rows) >= self.flush_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self.rows:
+            return
+        rows = [(profile_name, *watermark) for profile_name, watermark in self.rows.items()]
+        self.rows = {}
+        if await update_last_entries(rows):
+            self.written += len(rows)
+        else:
+            self.failed.update(row[0] for row in rows)
+
+
+### feed_cache ###
+
+# Loads the stored RSS validators of the given profiles for the task loop's conditional GET requests
+# Returns a dict of profile_name -> (etag, last_modified, body_hash)
+@run_in_db_thread
+def load_feed_validators(profile_names):
+    try:
+        with get_db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """SELECT profile_name, etag, last_modified, body_hash
+                FROM feed_cache
+                WHERE profile_name = ANY(%s)""",
+                (list(profile_names),)
+            )
+            return {row[0]: (row[1], row[2], row[3]) for row in cur.fetchall()}
+    except psycopg2.Error as e:
+        my_logger.error(f"Error loading feed validators: {e}")
+        return {}
+
+# Stores the validators of every feed that changed during the task loop in one statement
+# Profiles removed while the loop ran are skipped, their rows would only be deleted again
+@run_in_db_thread
+def save_feed_validators(validators):
+    if not validators:
+        return
+    rows = [(profile_name, etag, last_modified, body_hash)
+            for profile_name, (etag, last_modified, body_hash) in validators.items()]
+    try:
+        with get_db_connection() as conn, conn.cursor() as cur:
+            execute_values(
+                cur,
+                """INSERT INTO feed_cache (profile_name, etag, last_modified, body_hash)
+                SELECT v.* FROM (VALUES %s) AS v(profile_name, etag, last_modified, body_hash)
+                WHERE EXISTS (SELECT 1 FROM profiles p WHERE p.profile_name = v.profile_name)
+                ON CONFLICT (profile_name) DO UPDATE
+                SET etag = EXCLUDED.etag, last_modified = EXCLUDED.last_modified,
+                    body_hash = EXCLUDED.body_hash, updated_at = now()""",
+                rows,
+                template="(%s, %s::text, %s::text, %s::text)",
+                page_size=len(rows)
+            )
+            conn.commit()
+    except psycopg2.Error as e:
+        my_logger.error(f"Error saving feed validators: {e}")
+
+
+### poll_schedule ###
+
+# Returns a dict of profile_name -> (last_entry_at, mean_gap) for the given profiles that have been polled before
+@run_in_db_thread
+def load_poll_schedule(profile_names):
+    try:
+        with get_db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """SELECT profile_name, last_entry_at, mean_gap
+                FROM poll_schedule
+                WHERE profile_name = ANY(%s)""",
+                (list(profile_names),)
+            )
+            return {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+    except psycopg2.Error as e:
+        my_logger.error(f"Error loading poll schedule: {e}")
+        return {}
+
+# 'rows' is a list of (profile_name, last_entry_at, mean_gap, next_poll_at), all written in one statement
+# Profiles removed while the loop ran are skipped, like in save_feed_validators()
+@run_in_db_thread
+def save_poll_schedule(rows):
+    if not rows:
+        return
+    try:
+        with get_db_connection() as conn, conn.cursor() as cur:
+            execute_values(
+                cur,
+                """INSERT INTO poll_schedule (profile_name, last_entry_at, mean_gap, next_poll_at)
+                SELECT v.* FROM (VALUES %s) AS v(profile_name, last_entry_at, mean_gap, next_poll_at)
+                WHERE EXISTS (SELECT 1 FROM profiles p WHERE p.profile_name = v.profile_name)
+                ON CONFLICT (profile_name) DO UPDATE
+                SET last_entry_at = EXCLUDED.last_entry_at, mean_gap = EXCLUDED.mean_gap,
+                    next_poll_at = EXCLUDED.next_poll_at, updated_at = now()""",
+                rows,
+                template="(%s, %s::timestamptz, %s::float8, %s::timestamptz)",
+                page_size=len(rows)
+            )
+            conn.commit()
+    except psycopg2.Error as e:
+        my_logger.error(f"Error saving poll schedule: {e}")
+
+
+### poll_jobs ###
+
+# Queues a poll for every profile that doesn't already have one queued, running or waiting to be posted
+# 'jobs' is a list of (profile_name, last_guid, last_pub_date, last_entry, profile_url, profile_image, etag, last_modified, body_hash)
+# Returns how many jobs were actually queued
+@run_in_db_thread
+def enqueue_poll_jobs(jobs):
+    if not jobs:
+        return 0
+    try:
+        with get_db_connection() as conn, conn.cursor() as cur:
+            execute_values(
+                cur,
+                """INSERT INTO poll_jobs (profile_name, last_guid, last_pub_date, last_entry, profile_url, profile_image, etag, last_modified, body_hash)
+                VALUES %s
+                ON CONFLICT (profile_name) WHERE status IN ('queued', 'running', 'done') DO NOTHING""",
+                jobs,
+                page_size=len(jobs)
+            )
+            queued = cur.rowcount
+            conn.commit()
+            return queued
+    except psycopg2.Error as e:
+        my_logger.error(f"Error queueing poll jobs: {e}")
+        return 0
+
+# Claims up to 'limit' queued jobs for one worker
+# SKIP LOCKED lets any number of workers claim at the same time without waiting on or double claiming a job
+@run_in_db_thread
+def claim_poll_jobs(worker_id, limit):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """UPDATE poll_jobs
+            SET status = 'running', claimed_by = %s, claimed_at = now(), attempts = attempts + 1
+            WHERE job_id IN (
+                SELECT job_id FROM poll_jobs
+                WHERE status = 'queued'
+                ORDER BY job_id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING job_id, profile_name, last_guid, last_pub_date, last_entry, profile_url, profile_image, etag, last_modified, body_hash""",
+            (worker_id, limit)
+        )
+        jobs = cur.fetchall()
+        conn.commit()
+        return jobs
+
+# 'rows' is a list of (job_id, result, worker_id), jobs that were handed to another worker in the meantime are left alone
+@run_in_db_thread
+def finish_poll_jobs(rows):
+    if not rows:
+        return
+    try:
+        with get_db_connection() as conn, conn.cursor() as cur:
+            execute_values(
+                cur,
+                """UPDATE poll_jobs AS pj
+                SET status = 'done', result = v.result, finished_at = now()
+                FROM (VALUES %s) AS v(job_id, result, worker_id)
+                WHERE pj.job_id = v.job_id AND pj.status = 'running' AND pj.claimed_by = v.worker_id""",
+                [(job_id, Json(result), worker_id) for job_id, result, worker_id in rows],
+                template="(%s::bigint, %s::jsonb, %s)",
+                page_size=len(rows)
+            )
+            conn.commit()
+    except psycopg2.Error as e:
+        my_logger.error(f"Error storing poll job results: {e}")
+
+# Puts a job back in the queue after a worker error, or marks it failed once it has used up 'max_attempts'
+@run_in_db_thread
+def release_poll_job(job_id, worker_id, max_attempts):
+    try:
+        with get_db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """UPDATE poll_jobs
+                SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'queued' END,
+                    claimed_by = NULL, finished_at = now()
+                WHERE job_id = %s AND status = 'running' AND claimed_by = %s""",
+                (max_attempts, job_id, worker_id)
+            )
+            conn.commit()
+    except psycopg2.Error as e:
+        my_logger.error(f"Error releasing poll job {job_id}: {e}")
+
+# Jobs still running after 'timeout' seconds belonged to a worker that died, they go back in the queue
+# unless they've used up 'max_attempts', so a feed that kills every worker picking it up ends up failed instead
+@run_in_db_thread
+def requeue_stale_poll_jobs(timeout, max_attempts):
+    try:
+        with get_db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """UPDATE poll_jobs
+                SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'queued' END,
+                    claimed_by = NULL, finished_at = now()
+                WHERE status = 'running' AND claimed_at < now() - make_interval(secs => %s)""",
+                (max_attempts, timeout)
+            )
+            requeued = cur.rowcount
+            conn.commit()
+            return requeued
+    except psycopg2.Error as e:
+        my_logger.error(f"Error requeueing stale poll jobs: {e}")
+        return 0
+
+# Returns a list of (job_id, profile_name, status, result) for the jobs workers are done with
+@run_in_db_thread
+def get_finished_poll_jobs(limit):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """SELECT job_id, profile_name, status, result
+            FROM poll_jobs
+            WHERE status IN ('done', 'failed')
+            ORDER BY job_id
+            LIMIT %s""",
+            (limit,)
+        )
+        return cur.fetchall()
+
+@run_in_db_thread
+def delete_poll_jobs(job_ids):
+    if not job_ids:
+        return
+    try:
+        with get_db_connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM poll_jobs WHERE job_id = ANY(%s)", (list(job_ids),))
+            conn.commit()
+    except psycopg2.Error as e:
+        my_logger.error(f"Error deleting poll jobs: {e}")
+
+
+### omdb_cache ###
+
+# Returns a list of (cache_key, payload, age in seconds) for entries younger than 'max_age', newest first
+@run_in_db_thread
+def load_omdb_cache(limit, max_age):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM omdb_cache WHERE fetched_at < now() - make_interval(secs => %s)", (max_age,))
+        conn.commit()
+        cur.execute(
+            """SELECT cache_key, payload, EXTRACT(EPOCH FROM now() - fetched_at)
+            FROM omdb_cache
+            ORDER BY fetched_at DESC
+            LIMIT %s""",
+            (limit,)
+        )
+        return cur.fetchall()
+
+@run_in_db_thread
+def save_omdb_entry(cache_key, payload):
+    try:
+        with get_db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """INSERT INTO omdb_cache (cache_key, payload, fetched_at)
+                VALUES (%s, %s, now())
+                ON CONFLICT (cache_key) DO UPDATE
+                SET payload = EXCLUDED.payload, fetched_at = now()""",
+                (cache_key, Json(payload))
+            )
+            conn.commit()
+    except psycopg2.Error as e:
+        my_logger.error(f"Error saving OMDb cache entry {cache_key}: {e}")
+
+
+### loop_runs ###
+
+# 'run' is the dict of loop_runs columns built at the end of diary.run_diary_loop()
+# Runs older than 'retention' seconds are deleted in the same transaction
+@run_in_db_thread
+def save_loop_run(run, retention):
+    try:
+        with get_db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """INSERT INTO loop_runs (started_at, finished_at, slots, profiles_polled, fetch_seconds, parse_seconds,
+                    new_entries, messages_queued, messages_sent, scrape_errors, error, slowest_profiles)
+                VALUES (%(started_at)s, %(finished_at)s, %(slots)s, %(profiles_polled)s, %(fetch_seconds)s, %(parse_seconds)s,
+                    %(new_entries)s, %(messages_queued)s, %(messages_sent)s, %(scrape_errors)s, %(error)s, %(slowest_profiles)s)""",
+                {**run, "slowest_profiles": Json(run["slowest_profiles"])}
+            )
+            cur.execute("DELETE FROM loop_runs WHERE started_at < now() - make_interval(secs => %s)", (retention,))
+            conn.commit()
+    except psycopg2.Error as e:
+        my_logger.error(f"Error saving loop run: {e}")
+
+# One row per day over the last 'days' days, newest first:
+# (day, runs, avg/p95/max run seconds, avg profiles polled, new entries, messages sent, scrape errors, failed runs)
+@run_in_db_thread
+def get_loop_run_summary(days):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """SELECT date_trunc('day', started_at) AS day, count(*),
+                avg(duration), percentile_cont(0.95) WITHIN GROUP (ORDER BY duration), max(duration),
+                avg(profiles_polled), sum(new_entries), sum(messages_sent), sum(scrape_errors), count(error)
+            FROM (
+                SELECT *, EXTRACT(EPOCH FROM finished_at - started_at)::float8 AS duration
+                FROM loop_runs
+                WHERE started_at >= date_trunc('day', now()) - make_interval(days => %s)
+            ) runs
+            GROUP BY day
+            ORDER BY day DESC""",
+            (days - 1,)
+        )
+        return cur.fetchall()
+
+# Profiles that made the slowest list of a run in the last 'days' days, as (profile_name, times listed, max and avg seconds)
+@run_in_db_thread
+def get_slowest_profiles(days, limit):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """SELECT slow.profile_name, count(*), max(slow.seconds), avg(slow.seconds)
+            FROM loop_runs, jsonb_to_recordset(loop_runs.slowest_profiles) AS slow(profile_name TEXT, seconds FLOAT8)
+            WHERE loop_runs.started_at >= now() - make_interval(days => %s)
+            GROUP BY slow.profile_name
+            ORDER BY max(slow.seconds) DESC
+            LIMIT %s""",
+            (days, limit)
+        )
+        return cur.fetchall()
@@ -0,0 +1,94 @@
+import asyncio, logging, threading, time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+from config import SCRAPE_REQUESTS_PER_SECOND, SCRAPE_BURST, SCRAPE_MIN_REQUESTS_PER_SECOND
+
+my_logger = logging.getLogger("mybot")
+
+BACKOFF_FACTOR = 0.5    # Rate is multiplied by this on every 429/5xx
+RECOVERY_STEP = 0.1     # Requests per second added back on every successful response
+
+
+# Token bucket shared by every request to one host, both the threaded requests.get calls and the
+# task loop's aiohttp session take tokens from it
+# The rate shrinks when the host answers with 429/5xx and slowly climbs back to 'max_rate' on success
+# Priority requests (slash commands someone is waiting on) skip the queue the task loop builds up,
+# they still take a token so the loop's later requests make room for them, and only queue behind each other
+class TokenBucket:
+    def __init__(self, host, max_rate, burst, min_rate):
+        self.host = host
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.priority_next = 0.0    # earliest time the next priority request may go
+        self.lock = threading.Lock()
+
+    # Takes a token and returns how long the caller has to wait before using it
+    # Tokens can go negative, which queues callers behind each other instead of having them race
+    def _reserve(self, priority=False):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            delay = max(0.0, self.blocked_until - now)
+            if priority:
+                delay = max(delay, self.priority_next - now)
+                self.priority_next = now + delay + 1 / self.rate
+            elif self.tokens < 0:
+                delay = max(delay, -self.tokens / self.rate)
+            return delay
+
+    def acquire(self, priority=False):
+        delay = self._reserve(priority)
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        delay = self._reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    # Feeds the response back into the bucket, 'status' is None when the request itself failed
+    def record(self, status, retry_after=None):
+        with self.lock:
+            if status is None or status == 429 or status >= 500:
+                self.rate = max(self.min_rate, self.rate * BACKOFF_FACTOR)
+                pause = parse_retry_after(retry_after)
+                if pause:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+                my_logger.warning(f"{self.host} answered {status}, request rate lowered to {self.rate:.2f}/s")
+            elif self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + RECOVERY_STEP)
+
+
+# Retry-After is either a number of seconds or an HTTP date
+def parse_retry_after(value):
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return 0.0
+
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+def get_limiter(url):
+    host = urlsplit(url).hostname
+    with limiters_lock:
+        if host not in limiters:
+            limiters[host] = TokenBucket(host, SCRAPE_REQUESTS_PER_SECOND, SCRAPE_BURST, SCRAPE_MIN_REQUESTS_PER_SECOND)
+        return limiters[host]
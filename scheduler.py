@@ -0,0 +1,91 @@
+import hashlib, logging, time
+from datetime import datetime, timedelta, timezone
+from config import TASK_LOOP_INTERVAL, SCHEDULER_SLOTS, MAX_POLL_INTERVAL, POLL_BACKOFF_FACTOR, ACTIVITY_SMOOTHING
+from scraping import parsePubDate
+
+my_logger = logging.getLogger("mybot")
+
+SLOT_SECONDS = TASK_LOOP_INTERVAL * 60 / SCHEDULER_SLOTS
+# A profile comes around once per turn of the wheel, so a poll due within half a turn is taken now
+# instead of a few seconds of jitter pushing it back a whole turn
+DUE_WITHIN = TASK_LOOP_INTERVAL * 60 / 2
+
+
+# Stable slot for a profile, the same name always hashes to the same point in the interval
+# (Python's hash() is salted per process, so it can't be used here)
+def profile_slot(profile_name):
+    digest = hashlib.sha1(profile_name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % SCHEDULER_SLOTS
+
+
+# Splits TASK_LOOP_INTERVAL into SCHEDULER_SLOTS slots and hands each profile out in its own slot,
+# so the polls, database writes and sends are spread over the whole interval instead of one burst
+# Slots come from the wall clock, so a restart or a late task run doesn't reshuffle anyone
+# Each profile's slot is stored on its profiles row, so a slot's diary rows come straight out of the database
+# and added profiles get picked up in their slot, removed ones drop out without moving any other profile
+class TimeWheel:
+    def __init__(self):
+        self.last_tick = None
+
+    # Returns the wheel slots that came due since the last call
+    # Normally one, more if a task run was late, never more than a full turn
+    def due_slots(self, now=None):
+        tick = int((now or time.time()) // SLOT_SECONDS)
+        if self.last_tick is None:
+            self.last_tick = tick - 1
+        elif tick - self.last_tick > SCHEDULER_SLOTS:
+            self.last_tick = tick - SCHEDULER_SLOTS
+        if tick <= self.last_tick:
+            return []
+
+        slots = [t % SCHEDULER_SLOTS for t in range(self.last_tick + 1, tick + 1)]
+        if len(slots) > 1:
+            my_logger.warning(f"Time wheel catching up on {len(slots)} slots")
+        self.last_tick = tick
+        return slots
+
+
+### Adaptive poll intervals ###
+
+# Folds the pubDates read from a profile's feed into its activity history
+# Returns the (last_entry_at, mean_gap) pair, mean_gap being a moving average of the seconds between entries
+def update_activity(last_entry_at, mean_gap, pub_dates):
+    dates = sorted(date for date in map(parsePubDate, pub_dates) if date)
+    for date in dates:
+        if last_entry_at is not None:
+            if date <= last_entry_at:
+                continue
+            gap = (date - last_entry_at).total_seconds()
+            mean_gap = gap if mean_gap is None else ACTIVITY_SMOOTHING * gap + (1 - ACTIVITY_SMOOTHING) * mean_gap
+        last_entry_at = date
+    return last_entry_at, mean_gap
+
+
+# Seconds until a profile should be polled again
+# A fraction of how long the profile has been quiet, or of its usual gap between entries if that's longer,
+# so someone logging every day stays on every turn of the wheel and a dormant profile backs off to MAX_POLL_INTERVAL
+# Always a whole number of turns, rounded to the nearest, since the profile is only looked at in its own slot
+# A profile with no entries yet (just added, or an empty diary) stays on every turn, its first log shouldn't wait
+def poll_interval(last_entry_at, mean_gap, now):
+    base = TASK_LOOP_INTERVAL * 60
+    max_turns = max(MAX_POLL_INTERVAL * 60 // base, 1)
+    if last_entry_at is None:
+        return base
+
+    quiet = max((now - last_entry_at).total_seconds(), mean_gap or 0)
+    turns = round(quiet * POLL_BACKOFF_FACTOR / base)
+    return min(max(turns, 1), max_turns) * base
+
+
+# Builds the poll_schedule rows for the profiles polled this run
+# 'schedule' is profile_name -> (last_entry_at, mean_gap) as stored, 'activity' is profile_name -> (guid, pubDate) of the items seen
+# Profiles whose poll failed aren't in 'activity' and keep their old schedule, so they're retried next turn
+def plan_next_polls(schedule, activity, now=None):
+    now = now or datetime.now(timezone.utc)
+    rows = []
+    for profile_name, seen in activity.items():
+        pub_dates = [pub_date for _, pub_date in seen]
+        last_entry_at, mean_gap = update_activity(*schedule.get(profile_name, (None, None)), pub_dates)
+        next_poll_at = now + timedelta(seconds=poll_interval(last_entry_at, mean_gap, now))
+        rows.append((profile_name, last_entry_at, mean_gap, next_poll_at))
+    return rows
@@ -0,0 +1,157 @@
+import psycopg2, logging
+from database import get_db_connection
+
+my_logger = logging.getLogger("mybot")
+
+
+# Tables added on top of the original discord_servers, server_channels and diary_users tables
+# Each migration runs once and is recorded in 'schema_migrations', new ones are only ever appended to the end
+MIGRATIONS = [
+    ("001_feed_cache", """
+        CREATE TABLE IF NOT EXISTS feed_cache (
+            profile_name TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            body_hash TEXT,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )"""),
+    ("002_omdb_cache", """
+        CREATE TABLE IF NOT EXISTS omdb_cache (
+            cache_key TEXT PRIMARY KEY,
+            payload JSONB NOT NULL,
+            fetched_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )"""),
+    ("003_poll_schedule", """
+        CREATE TABLE IF NOT EXISTS poll_schedule (
+            profile_name TEXT PRIMARY KEY,
+            last_entry_at TIMESTAMPTZ,
+            mean_gap DOUBLE PRECISION,
+            next_poll_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )"""),
+    ("004_poll_jobs", """
+        CREATE TABLE IF NOT EXISTS poll_jobs (
+            job_id BIGSERIAL PRIMARY KEY,
+            profile_name TEXT NOT NULL,
+            last_entry TEXT,
+            profile_url TEXT,
+            profile_image TEXT,
+            etag TEXT,
+            last_modified TEXT,
+            body_hash TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            claimed_by TEXT,
+            claimed_at TIMESTAMPTZ,
+            result JSONB,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS poll_jobs_active_profile ON poll_jobs (profile_name)
+            WHERE status IN ('queued', 'running', 'done');
+        CREATE INDEX IF NOT EXISTS poll_jobs_queued ON poll_jobs (job_id) WHERE status = 'queued'"""),
+    # Scrape state is kept once per Letterboxd profile instead of once per (profile, server) in diary_users,
+    # servers subscribe to a profile through profile_subscriptions
+    # diary_users is copied over and left as it was, nothing reads or writes it after this
+    ("005_profiles", """
+        CREATE TABLE IF NOT EXISTS profiles (
+            profile_name TEXT PRIMARY KEY,
+            profile_url TEXT,
+            profile_image TEXT,
+            last_entry TEXT,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE TABLE IF NOT EXISTS profile_subscriptions (
+            profile_name TEXT NOT NULL REFERENCES profiles (profile_name) ON DELETE CASCADE,
+            server_id BIGINT NOT NULL REFERENCES discord_servers (server_id) ON DELETE CASCADE,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (profile_name, server_id)
+        );
+        CREATE INDEX IF NOT EXISTS profile_subscriptions_server ON profile_subscriptions (server_id);
+
+        INSERT INTO profiles (profile_name, profile_url, profile_image, last_entry, updated_at)
+        SELECT DISTINCT ON (profile_name) profile_name, profile_url, profile_image, last_entry, COALESCE(updated_at, now())
+        FROM diary_users
+        ORDER BY profile_name, updated_at DESC NULLS LAST
+        ON CONFLICT (profile_name) DO NOTHING;
+
+        INSERT INTO profile_subscriptions (profile_name, server_id)
+        SELECT profile_name, server_id
+        FROM diary_users
+        WHERE server_id IN (SELECT server_id FROM discord_servers)
+        ON CONFLICT (profile_name, server_id) DO NOTHING"""),
+    # New entries are found by the guid and pubDate of the last entry posted instead of its film title
+    ("006_entry_watermark", """
+        ALTER TABLE profiles ADD COLUMN IF NOT EXISTS last_guid TEXT;
+        ALTER TABLE profiles ADD COLUMN IF NOT EXISTS last_pub_date TIMESTAMPTZ;
+        ALTER TABLE poll_jobs ADD COLUMN IF NOT EXISTS last_guid TEXT;
+        ALTER TABLE poll_jobs ADD COLUMN IF NOT EXISTS last_pub_date TIMESTAMPTZ"""),
+    # Existing images have no fetch time, so they all count as stale and get refreshed in the background
+    ("007_profile_image_refresh", """
+        ALTER TABLE profiles ADD COLUMN IF NOT EXISTS image_fetched_at TIMESTAMPTZ;
+        CREATE INDEX IF NOT EXISTS profiles_image_fetched_at ON profiles (image_fetched_at NULLS FIRST)"""),
+    # One row per task loop run, read by botstats.py
+    ("008_loop_runs", """
+        CREATE TABLE IF NOT EXISTS loop_runs (
+            run_id BIGSERIAL PRIMARY KEY,
+            started_at TIMESTAMPTZ NOT NULL,
+            finished_at TIMESTAMPTZ NOT NULL,
+            slots INTEGER NOT NULL,
+            profiles_polled INTEGER NOT NULL,
+            fetch_seconds DOUBLE PRECISION NOT NULL,
+            parse_seconds DOUBLE PRECISION NOT NULL,
+            new_entries INTEGER NOT NULL,
+            messages_queued INTEGER NOT NULL,
+            messages_sent INTEGER NOT NULL,
+            scrape_errors INTEGER NOT NULL,
+            error TEXT,
+            slowest_profiles JSONB NOT NULL DEFAULT '[]'
+        );
+        CREATE INDEX IF NOT EXISTS loop_runs_started_at ON loop_runs (started_at)"""),
+    # Each profile's time wheel slot, so a slot's diary rows are picked out in SQL instead of from the whole fleet
+    # Filled in by queries.assign_profile_slots() on startup and by /add
+    ("009_profile_slots", """
+        ALTER TABLE profiles ADD COLUMN IF NOT EXISTS slot SMALLINT;
+        CREATE INDEX IF NOT EXISTS profiles_slot ON profiles (slot)"""),
+    # A profile's poll schedule and feed validators go with it, so one that's removed and added again
+    # is polled straight away instead of keeping the next_poll_at it had backed off to
+    ("010_profile_state_cascade", """
+        DELETE FROM poll_schedule WHERE profile_name NOT IN (SELECT profile_name FROM profiles);
+        DELETE FROM feed_cache WHERE profile_name NOT IN (SELECT profile_name FROM profiles);
+        ALTER TABLE poll_schedule ADD CONSTRAINT poll_schedule_profile_name_fkey
+            FOREIGN KEY (profile_name) REFERENCES profiles (profile_name) ON DELETE CASCADE;
+        ALTER TABLE feed_cache ADD CONSTRAINT feed_cache_profile_name_fkey
+            FOREIGN KEY (profile_name) REFERENCES profiles (profile_name) ON DELETE CASCADE"""),
+    # Profiles left behind without a subscription, by 005 for servers that were already gone and by
+    # remove_guild() before it pruned them, they were still having their images refreshed
+    ("011_prune_orphan_profiles", """
+        DELETE FROM profiles p
+        WHERE NOT EXISTS (SELECT 1 FROM profile_subscriptions ps WHERE ps.profile_name = p.profile_name)"""),
+]
+
+
+# Called once from on_ready() before the task loop starts
+def apply_migrations():
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+            name TEXT PRIMARY KEY,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )""")
+        conn.commit()
+
+        cur.execute("SELECT name FROM schema_migrations")
+        applied = {row[0] for row in cur.fetchall()}
+
+        for name, query in MIGRATIONS:
+            if name in applied:
+                continue
+            try:
+                cur.execute(query)
+                cur.execute("INSERT INTO schema_migrations (name) VALUES (%s)", (name,))
+            except psycopg2.Error as e:
+                my_logger.error(f"Failed to apply migration {name}: {e}")
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+                my_logger.info(f"Applied migration {name}")
@@ -1,6 +1,11 @@
 from bs4 import BeautifulSoup
-import requests, logging
-from time import sleep
+from lxml import etree, html
+from io import BytesIO
+from email.utils import parsedate_to_datetime
+import requests, logging, hashlib, asyncio, aiohttp
+from config import DIARY_CATCH_UP_LIMIT, LETTERBOXD_URL
+from ratelimit import get_limiter
+from metrics import STAGE_SECONDS, SCRAPE_OUTCOMES
 
 my_logger = logging.getLogger("mybot")
 
@@ -11,6 +16,20 @@ headers = {
     }  
 
 
+# Every request to Letterboxd goes through the host's shared rate limiter
+# 'priority' is for slash commands, so they don't wait behind a busy task loop's requests
+def limitedGet(url, priority=False, **kwargs):
+    limiter = get_limiter(url)
+    limiter.acquire(priority)
+    try:
+        result = requests.get(url, **kwargs)
+    except requests.RequestException:
+        limiter.record(None)
+        raise
+    limiter.record(result.status_code, result.headers.get("Retry-After"))
+    return result
+
+
 def filmTitle(data, last_entry):
     title_name = data.find("a")
     if title_name and title_name.string:
@@ -66,22 +85,11 @@ def filmRewatch(data):
     
     return True
 
-def filmPoster(data):
-    description = data.find("description")
-
-    if description and description.text:
-        soup = BeautifulSoup(description.text, "html.parser")
-        img = soup.find("img")
-        if img and img.has_attr("src"):
-            return img["src"]
-        
-    return False
-
-def profileImage(data):
-    url = f"https://letterboxd.com/{data}/"
+def profileImage(data, priority=False):
+    url = f"{LETTERBOXD_URL}/{data}/"
     
     try:
-        result = requests.get(url, headers=headers)
+        result = limitedGet(url, priority, headers=headers)
         if result.status_code != 200:
                 my_logger.error(f"Failed to fetch page (status {result.status_code}) for {data}")
                 return False
@@ -101,10 +109,10 @@ def profileImage(data):
 # Initial HTML scrape when a new user is added
 # Also is used as a verification if the added username exist on Letterboxd
 def firstScrape(profile):
-    url = f"https://letterboxd.com/{profile}/diary/"
+    url = f"{LETTERBOXD_URL}/{profile}/diary/"
     UNMATCHABLE_TITLE = "__UNMATCHABLE__"
     try:
-        result = requests.get(url, headers=headers)
+        result = limitedGet(url, headers=headers)
         if result.status_code != 200:
                 my_logger.error(f"Failed to fetch page (status {result.status_code})")
                 return False
@@ -135,39 +143,31 @@ def firstScrape(profile):
 
 # Initial RSS scrape when a new user is added
 # Also is used as a verification if the added username exist on Letterboxd
-def firstScrape_rss(profile):
-    url = f"https://letterboxd.com/{profile}/rss/"
+# The profile page is only scraped for the image with 'withImage', otherwise the image slot is None
+def firstScrape_rss(profile, withImage=True, priority=False):
+    url = f"{LETTERBOXD_URL}/{profile}/rss/"
     UNMATCHABLE_TITLE = "__UNMATCHABLE__"
     try:
-        result = requests.get(url, headers=headers, timeout=10)
+        result = limitedGet(url, priority, headers=headers, timeout=10)
         if result.status_code != 200:
                 my_logger.error(f"Failed to fetch page (status {result.status_code})")
                 return False
         
-        doc = BeautifulSoup(result.text, "xml")
-        channel = doc.find("channel")
-        if not channel:
+        try:
+            # List posts show up in the same feed but aren't diary entries, they have no film title
+            item = next((item for item in iterFeed_rss(result.content) if item.get("filmTitle")), None)
+        except ValueError:
             my_logger.info(f"Invalid or non-existent user: {profile}. Or not a valid RSS feed.")
             return False
-        items = doc.find_all("item")
         
-        if not items:
-            profile_image = profileImage(profile)
-
+        profile_image = profileImage(profile, priority) if withImage else None
+        if not item:
             return "no_entry", profile_image
         else:
-            item = items[0]
-
-            film_title = item.find("letterboxd:filmTitle").string
-            film_release = item.find("letterboxd:filmYear").string
-            film_rating = item.find("letterboxd:memberRating").string if item.find("letterboxd:memberRating") else "0"
-            film_review = filmReview(item)
-            diary_url = item.find("link").string
-            film_rewatch = False if item.find("letterboxd:rewatch").string == "No" else True
-            film_poster = filmPoster(item)
-            profile_image = profileImage(profile)
+            film_title, film_release, film_rating, film_review, diary_url, film_rewatch, film_poster = feedEntry(item)
             #filmImage(details)
-            return True, film_title, film_release, film_rating, film_review, diary_url, film_rewatch, film_poster, profile_image
+            # The entry's guid and pubDate are the new profile's watermark
+            return True, film_title, film_release, film_rating, film_review, diary_url, film_rewatch, film_poster, profile_image, item.get("guid"), parsePubDate(item.get("pubDate"))
     except Exception as e:
         my_logger.error(f"Error retrieving {profile} info: {e}")
         return False
@@ -176,7 +176,7 @@ def firstScrape_rss(profile):
 # HTML Scraping performed during the diary task loop
 # Configured to only scrape the 5 most recent entries so to not spam a channel's chat if there are more to grab
 def diaryScrape(profile, entry):
-    url = f"https://letterboxd.com/{profile}/diary/"
+    url = f"{LETTERBOXD_URL}/{profile}/diary/"
     film_title = []
     film_release = []
     film_rating = []
@@ -187,7 +187,7 @@ def diaryScrape(profile, entry):
     #sleep(5.0) 
 
     try:
-        result = requests.get(url, headers=headers)
+        result = limitedGet(url, headers=headers)
         if result.status_code != 200:
                 my_logger.error(f"Failed to fetch page (status {result.status_code})")
                 my_logger.debug(f"URL attempted: {url}")
@@ -235,8 +235,80 @@ def diaryScrape(profile, entry):
 
 # RSS Scraping performed during the diary task loop
 # Configured to only scrape the 5 most recent entries so to not spam a channel's chat if there are more to grab
-def diaryScrape_rss(profile, entry):
-    url = f"https://letterboxd.com/{profile}/rss/"
+def diaryScrape_rss(profile, watermark):
+    url = f"{LETTERBOXD_URL}/{profile}/rss/"
+
+    try:
+        result = limitedGet(url, headers=headers, timeout=10)
+        if result.status_code != 200:
+                my_logger.error(f"Failed to fetch page (status {result.status_code})")
+                return False, None
+        
+        return diaryParse_rss(result.text, profile, watermark)
+        
+    except Exception as e:
+        my_logger.error(f"Error retrieving {profile} info: {e}")
+        return False, None
+
+
+# Conditional GET of a profile's RSS feed for the diary task loop, done through a shared aiohttp session
+# 'validators' is the (etag, last_modified, body_hash) stored from the previous fetch of this feed
+# Returns (status, body, validators) where status is:
+#   "not_modified" - server answered 304, nothing was downloaded
+#   "unchanged"    - server sent the feed but it hashes the same as last time
+#   "modified"     - feed changed and 'body' needs to be parsed
+#   False          - request failed
+async def fetchFeed_rss(session, profile, validators=None):
+    url = f"{LETTERBOXD_URL}/{profile}/rss/"
+    etag, last_modified, body_hash = validators or (None, None, None)
+
+    request_headers = {}
+    if etag:
+        request_headers["If-None-Match"] = etag
+    if last_modified:
+        request_headers["If-Modified-Since"] = last_modified
+
+    limiter = get_limiter(url)
+    try:
+        await limiter.acquire_async()
+        # Timed from after the rate limiter lets the request through, waiting for a token isn't Letterboxd's time
+        with STAGE_SECONDS.time("fetch_feed"):
+            async with session.get(url, headers=request_headers) as result:
+                limiter.record(result.status, result.headers.get("Retry-After"))
+                if result.status == 304:
+                    return "not_modified", None, (etag, last_modified, body_hash)
+                if result.status != 200:
+                    my_logger.error(f"Failed to fetch page (status {result.status}) for {profile}")
+                    SCRAPE_OUTCOMES.inc("404" if result.status == 404 else "error")
+                    return False, None, validators
+                body = await result.read()
+                new_validators = (
+                    result.headers.get("ETag"),
+                    result.headers.get("Last-Modified"),
+                    hashlib.sha256(body).hexdigest(),
+                )
+
+        if body_hash and new_validators[2] == body_hash:
+            return "unchanged", body, new_validators
+        return "modified", body, new_validators
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        limiter.record(None)
+        my_logger.error(f"Error retrieving {profile} info: {e}")
+        SCRAPE_OUTCOMES.inc("error")
+        return False, None, validators
+    except Exception as e:
+        my_logger.error(f"Error retrieving {profile} info: {e}")
+        SCRAPE_OUTCOMES.inc("error")
+        return False, None, validators
+
+
+# Parses a diary RSS feed and returns the entries newer than the profile's watermark
+# 'watermark' is the (guid, pubDate, film title) of the last entry posted, see reachedWatermark()
+# The feed is streamed, so parsing stops at the watermark or after DIARY_CATCH_UP_LIMIT new entries instead of reading all 50
+# If a 'seenItems' list is passed, the (guid, pubDate) of every item read, newest first, is appended to it
+# List posts (items without a film title) are skipped but still count as seen, so the watermark moves past them
+def diaryParse_rss(body, profile, watermark, seenItems=None, limit=DIARY_CATCH_UP_LIMIT):
     film_title = []
     film_release = []
     film_rating = []
@@ -247,38 +319,15 @@ def diaryScrape_rss(profile, entry):
     throwaway_list = []
 
     try:
-        result = requests.get(url, headers=headers, timeout=10)
-        if result.status_code != 200:
-                my_logger.error(f"Failed to fetch page (status {result.status_code})")
-                return False, None
-        
-        doc = BeautifulSoup(result.text, "xml")
-        channel = doc.find("channel")
-        if not channel:
-            my_logger.info(f"Invalid or non-existent user: {profile}. Or not a valid RSS feed.")
-            return False, None
-        
-        items = doc.find_all("item")[:5]
-        first = True
+        for item in iterFeed_rss(body):
+            if seenItems is not None:
+                seenItems.append((item.get("guid"), item.get("pubDate")))
+            if reachedWatermark(item, watermark) or len(film_title) >= limit:
+                break
+            if not item.get("filmTitle"):
+                continue
 
-        if not items:
-            return False, None
-        
-        for item in items[:5]:
-            title = item.find("letterboxd:filmTitle").string
-            if title == entry:
-                if first:
-                    return False, None
-                else:
-                    break
-            first = False
-
-            released = item.find("letterboxd:filmYear").string
-            rating = item.find("letterboxd:memberRating").string if item.find("letterboxd:memberRating") else "0"
-            link = item.find("link").string
-            rewatch = filmRewatch(item)
-            poster_url = filmPoster(item)
-                
+            title, released, rating, _, link, rewatch, poster_url = feedEntry(item)
             film_title.append(title)
             film_release.append(released)
             film_rating.append(rating)
@@ -287,22 +336,123 @@ def diaryScrape_rss(profile, entry):
             film_rewatch.append(rewatch)
             film_poster.append(poster_url)
             throwaway_list.append("pass")
-            #filmImage(details)
-                
-        return True, film_title, film_release, film_rating, film_review, diary_url, film_rewatch, film_poster, throwaway_list
-        
-    except Exception as e:
-        my_logger.error(f"Error retrieving {profile} info: {e}")
+    except ValueError:
+        my_logger.info(f"Invalid or non-existent user: {profile}. Or not a valid RSS feed.")
         return False, None
 
+    if not film_title:
+        return False, None
+            
+    return True, film_title, film_release, film_rating, film_review, diary_url, film_rewatch, film_poster, throwaway_list
+
+
+# An item was already posted if it is the watermark entry itself or was published at or before it
+# Unlike film titles, guids stay unique across rewatches and same-title films, and the pubDate still
+# stops the parse when the watermark entry was deleted from the diary
+# Profiles stored before the guid watermark only have their last film title to go on until their next new entry
+def reachedWatermark(item, watermark):
+    last_guid, last_pub_date, last_entry = watermark
+    if not last_guid and not last_pub_date:
+        return bool(item.get("filmTitle")) and item.get("filmTitle") == last_entry
+
+    if last_guid and item.get("guid") == last_guid:
+        return True
+    pub_date = parsePubDate(item.get("pubDate"))
+    return bool(last_pub_date and pub_date and pub_date <= last_pub_date)
+
+
+# RSS pubDates are RFC 822 dates, returns an aware datetime or None if it can't be read
+def parsePubDate(value):
+    try:
+        pub_date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return pub_date if pub_date.tzinfo else None
+
+
+# Item fields read by iterFeed_rss(), namespaced tags like 'letterboxd:filmTitle' are matched on their local name
+RSS_ITEM_FIELDS = {"title", "link", "guid", "pubDate", "filmTitle", "filmYear", "memberRating", "rewatch", "description"}
+
+# Streams <item> elements out of an RSS body one at a time without building the whole document
+# Yields a dict of field -> text per item, nothing past the last item the caller asks for is parsed
+# Raises ValueError when the body has no <channel>, i.e. a missing user or not an RSS feed
+def iterFeed_rss(body):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+
+    context = etree.iterparse(BytesIO(body), events=("start", "end"), recover=True, resolve_entities=False, no_network=True)
+    has_channel = False
+    item = None
+    try:
+        for event, element in context:
+            tag = element.tag
+            if not isinstance(tag, str):
+                continue
+            tag = tag[tag.rfind("}") + 1:]
+
+            if event == "start":
+                if tag == "channel":
+                    has_channel = True
+                elif tag == "item" and has_channel:
+                    item = {}
+                continue
+
+            if item is None:
+                continue
+            if tag == "item":
+                yield item
+                item = None
+                # Drop finished items so memory stays flat on long feeds
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+            elif tag in RSS_ITEM_FIELDS:
+                item[tag] = element.text
+    except etree.XMLSyntaxError:
+        pass
+
+    if not has_channel:
+        raise ValueError("Not an RSS feed")
+
+
+# Turns one streamed item into the fields used by build_embed_message()
+# The poster and review both come out of the same parse of the item's <description> CDATA
+# Only /add shows the review link, the task loop's posts leave it out
+def feedEntry(item):
+    link = item.get("link")
+    poster_url = False
+    review = False
+
+    description = (item.get("description") or "").strip()
+    if description:
+        fragment = html.fragment_fromstring(description, create_parent="div")
+        img = fragment.find(".//img")
+        if img is not None and img.get("src"):
+            poster_url = img.get("src")
+        p_tags = fragment.findall(".//p")
+        if len(p_tags) > 1:
+            review_text = p_tags[1].text_content().strip()
+            if not review_text.startswith("Watched on "):
+                review = link
+
+    return (
+        item.get("filmTitle"),
+        item.get("filmYear"),
+        item.get("memberRating") or "0",
+        review,
+        link,
+        item.get("rewatch") == "Yes",
+        poster_url,
+    )
+
 
 # Scraping for users' favorite films listed on profile
-def favoriteFilmsScrape(profile):
-    url = f"https://letterboxd.com/{profile}/"
+def favoriteFilmsScrape(profile, priority=False):
+    url = f"{LETTERBOXD_URL}/{profile}/"
     titles = []
 
     try:
-        response = requests.get(url, headers=headers)
+        response = limitedGet(url, priority, headers=headers)
         if response.status_code != 200:
                 my_logger.error(f"Failed to fetch page (status {response.status_code})")
                 return False
@@ -335,7 +485,7 @@ def favoriteFilmsScrape(profile):
 # Should scrape all their pages if they have multiple
 # Not currently working, and not called anywhere
 def watchlistScrape(profile):
-    base_url = f"https://letterboxd.com/{profile}/watchlist"
+    base_url = f"{LETTERBOXD_URL}/{profile}/watchlist"
     page = 1
     titles = []
 
@@ -344,7 +494,7 @@ def watchlistScrape(profile):
         my_logger.debug(f"Scraping page {page} for {profile}...")
 
         try:
-            response = requests.get(url, headers=headers)
+            response = limitedGet(url, headers=headers)
             if response.status_code != 200:
                 my_logger.error(f"Failed to fetch page {page} (status {response.status_code})")
                 break
@@ -376,7 +526,6 @@ def watchlistScrape(profile):
                     titles.append(title)
 
             page += 1
-            sleep(2.0)
 
         except Exception as e:
             my_logger.error(f"Error scraping page {page}: {e}")
@@ -394,9 +543,9 @@ def watchlistScrape(profile):
 # Created only for the single-use function in the bot's on_ready()
 # Used to grab profile avatar images for database storage
 def profileImageOnReady(profile):
-    url = f"https://letterboxd.com/{profile}/diary/"
+    url = f"{LETTERBOXD_URL}/{profile}/diary/"
     try:
-        result = requests.get(url, headers=headers)
+        result = limitedGet(url, headers=headers)
         if result.status_code != 200:
                 my_logger.error(f"Failed to fetch page (status {result.status_code})")
                 return False
@@ -416,9 +565,9 @@ def profileImageOnReady(profile):
 # Was mostly used to test the scraping before the bot was created
 # Currently not called anywhere
 def scrapeSite(profile):
-    url = f"https://letterboxd.com/{profile}/diary/"
+    url = f"{LETTERBOXD_URL}/{profile}/diary/"
     try:
-        result = requests.get(url, headers=headers)
+        result = limitedGet(url, headers=headers)
         doc = BeautifulSoup(result.text, "html.parser")
         # with open("index.html", "w") as file:
             # file.write(result.text)
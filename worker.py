@@ -0,0 +1,84 @@
+import asyncio, logging, os, socket, psycopg2
+from config import WORKER_BATCH_SIZE, WORKER_IDLE_SLEEP, POLL_JOB_MAX_ATTEMPTS
+from helper import build_embed_message
+from poller import create_session, poll_profile
+from metrics import STAGE_SECONDS
+import queries
+
+# Scraper worker, run as many of these as needed next to the one main.py process (SCRAPE_IN_WORKERS = True)
+# Claims poll jobs from the poll_jobs table, scrapes and parses the feeds, builds the embeds
+# and hands the ready-to-send result back to the gateway through the same table
+# Run with: uv run worker.py
+
+# Logs go to stdout so several workers can run side by side, one per process or container
+my_logger = logging.getLogger("mybot")
+my_logger.setLevel(logging.INFO)
+
+handler = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+
+my_logger.addHandler(handler)
+my_logger.propagate = False
+
+worker_id = f"{socket.gethostname()}-{os.getpid()}"
+
+
+# Polls one claimed job and returns the result the gateway posts
+# Only JSON goes back through the table, so the embeds are sent as dicts
+async def run_job(session, job):
+    job_id, profile_name, last_guid, last_pub_date, last_entry, profile_url, profile_image, *validators = job
+    validators = tuple(validators)
+    watermark = (last_guid, last_pub_date, last_entry)
+    status, result, new_validators, size, seen = await poll_profile(session, profile_name, watermark, validators)
+
+    embeds, film_title = None, None
+    if result[0]:
+        with STAGE_SECONDS.time("build_embeds"):
+            built = await asyncio.to_thread(build_embed_message, result, profile_url, profile_name, profile_image)
+        if built:
+            embeds = [embed.to_dict() for embed in built[0]]
+            film_title = built[1]
+
+    return {
+        "status": status,
+        "size": size,
+        "seen": seen,
+        "validators": list(new_validators) if status and new_validators != validators else None,
+        "embeds": embeds,
+        "film_title": film_title,
+    }
+
+
+async def run_jobs(session, jobs):
+    outcomes = await asyncio.gather(*(run_job(session, job) for job in jobs), return_exceptions=True)
+
+    finished = []
+    for job, outcome in zip(jobs, outcomes):
+        if isinstance(outcome, BaseException):
+            my_logger.error(f"Error polling {job[1]} (job {job[0]}): {outcome}")
+            await queries.release_poll_job(job[0], worker_id, POLL_JOB_MAX_ATTEMPTS)
+        else:
+            finished.append((job[0], outcome, worker_id))
+    await queries.finish_poll_jobs(finished)
+    my_logger.info(f"Finished {len(finished)} of {len(jobs)} poll jobs")
+
+
+async def main():
+    my_logger.info(f"Worker {worker_id} started")
+    async with create_session() as session:
+        while True:
+            try:
+                jobs = await queries.claim_poll_jobs(worker_id, WORKER_BATCH_SIZE)
+            except psycopg2.Error as e:
+                my_logger.error(f"Error claiming poll jobs: {e}")
+                jobs = []
+
+            if not jobs:
+                await asyncio.sleep(WORKER_IDLE_SLEEP)
+                continue
+            await run_jobs(session, jobs)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())